@@ -1,5 +1,7 @@
 import argparse
 import logging.config
+import signal
+import sys
 
 # setup logging
 logging.config.dictConfig(
@@ -25,7 +27,12 @@ logging.config.dictConfig(
 from slooper.app import app_flask  # noqa: E402
 
 app = app_flask.app
-app_flask.load()
+# child processes (e.g. the audio engine) import this module again
+if __name__ != "__mp_main__":
+    app_flask.load()
+
+# exit gracefully on SIGTERM (e.g. from systemd) to save the session
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Slooper server")
@@ -2,22 +2,42 @@
 Main flask webapp.
 """
 
-from contextlib import contextmanager
+import json
 import logging
 from datetime import datetime
 
-from flask import Flask, send_file, abort, jsonify, render_template
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    render_template,
+    request,
+    stream_with_context,
+)
 import os
-from slooper.core.recording import State
-import slooper.core.stream as stream
+from slooper.core import engine, export, metrics
+from slooper.core.command import Command, Op, Quantize
+from slooper.core.recording import WRITING
+import slooper.core.stream as local_stream
 import string
 from sys import platform
-from threading import Lock
+from threading import Condition, Timer
+from timeit import default_timer as timer
+import unicodedata
+from urllib.parse import quote
+from types import ModuleType
+from typing import Union
+import uuid
 
 
 app = Flask(__name__)
 websocket_support = False
-load_lock = Lock()
+# the selected engine, the local stream module or a client of the engine
+# process with the same interface (see select_engine)
+stream: Union[ModuleType, engine.EngineClient] = local_stream
+load_lock = metrics.TimedLock()
+metrics.locks["load"] = load_lock
 
 
 def e_changed_state():
@@ -29,13 +49,42 @@ def e_changed_state():
 
 def try_stream_start(cfg):
     try:
-        stream.stream_start(device=cfg["device"], latency=cfg["latency"])
+        stream.stream_start(
+            device=cfg["device"],
+            latency=cfg["latency"],
+            vectorized_mixer=cfg.get("vectorized-mixer", True),
+            session_directory=cfg.get("session-dir", None),
+            spill_threshold_seconds=cfg.get("spill-threshold", None),
+            autosave_interval_seconds=cfg.get("autosave", None),
+            backend_name=cfg.get("backend", "sounddevice"),
+            backend_options=cfg.get("backend-options", None),
+            quantize=cfg.get("quantize", "block"),
+            input_ring_seconds=cfg.get("input-ring", 2.0),
+            storage_precision=cfg.get("precision", "float32"),
+            memory_budget_mb=cfg.get("memory-budget", None),
+            storage_kind=cfg.get("storage", "arena"),
+            record_offset_seconds=cfg.get("record-offset", 0.0) or 0.0,
+            adaptive_latency=cfg.get("adaptive-latency", False),
+        )
         return True
     except ValueError as e:
         logging.error(e)
         return False
 
 
+def select_engine(cfg):
+    """
+    Run the audio engine in this process (local) or in a separate process.
+    Must only be called while the stream is not running.
+    """
+    global stream
+    if cfg.get("engine", "local") == "process":
+        if not isinstance(stream, engine.EngineClient):
+            stream = engine.EngineClient()
+    else:
+        stream = local_stream
+
+
 def reset_usb(cfg):
     RESET_USB_DEVICES_KEY = "reset-usb-devices"
     assert isinstance(
@@ -51,8 +100,13 @@ def load():
 
     # only one thread should try loading
     with load_lock:
+        # the stream is None while it is restarted with the lock held
+        with stream.lock:
+            if stream.stream is not None:
+                return True
         logging.info("Loading..")
         cfg = stream.load_config()
+        select_engine(cfg)
 
         # try to start the stream
         if try_stream_start(cfg):
@@ -104,72 +158,216 @@ def main():
 def close():
     with stream.lock:
         stream.stream_close()
-        stream.recordings.clear()
+    stream.execute(Command(Op.Clear))
     return "Close"
 
 
-def get_state_dict(info: str = "", lock_stream=True):
-    if lock_stream:
-        stream.lock.acquire()
-
+def get_state_dict(info: str = ""):
     state_dict = {
         "stream": stream.get_stream_info_dict(),
         "recordings": dict(
             map(
                 lambda pair: (pair[0], pair[1].get_info_dict()),
-                stream.recordings.items(),
+                stream.get_recordings().items(),
             )
         ),
         "info": info,
     }
 
-    if lock_stream:
-        stream.lock.release()
-
     return state_dict
 
 
-def get_state_response(info: str = "", lock_stream=True):
-    return jsonify(get_state_dict(info, lock_stream))
+class StateCache:
+    """
+    Serialized state document that is only rebuilt if the state has changed.
+
+    Each rebuild that changes the document increments its version, which
+    serves as ETag together with the boot id. Versions restart with each
+    process, the boot id tells clients whether their version is from the
+    current process. Statistics of the stream are refreshed after max_age
+    seconds, changed statistics are announced like other changes.
+    """
+
+    def __init__(self, max_age: float = 10.0):
+        self.max_age = max_age
+        self.boot = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.state = {}
+        self.body = b""
+        self.stream_version = -1
+        self.time = 0.0
+        # notified after handlers have changed the state
+        self.changed = Condition()
+
+    def changed_since(self) -> bool:
+        if self.stream_version != stream.state_version:
+            return True
+        return timer() - self.time > self.max_age
+
+    def get(self):
+        """
+        Get the current document.
+
+        :return: version, state dict (must not be modified) and serialized state
+        """
+        with self.changed:
+            if self.changed_since():
+                # read the version first, the state can only be newer
+                refresh = self.stream_version == stream.state_version
+                self.stream_version = stream.state_version
+                self.time = timer()
+                state_dict = get_state_dict()
+                state_dict["boot"] = self.boot
+                state_dict["version"] = self.version
+                if state_dict != self.state:
+                    state_dict["version"] = self.version + 1
+                    self.body = json.dumps(state_dict).encode()
+                    self.state = state_dict
+                    self.version += 1
+                    if refresh:
+                        # nobody has announced the new statistics
+                        e_changed_state()
+            return self.version, self.state, self.body
+
+    def wait(self, version: int, timeout: float):
+        """
+        Wait until the document differs from the given version.
+
+        :param version: version that the client already has
+        :param timeout: maximum time to wait in seconds
+        """
+        deadline = timer() + timeout
+        with self.changed:
+            # rebuilds that do not change the document are not waited for
+            while self.get()[0] == version:
+                remaining = deadline - timer()
+                if remaining <= 0:
+                    return
+                # at the latest when the statistics are refreshed
+                self.changed.wait(min(remaining, self.max_age - (timer() - self.time)))
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+
+state_cache = StateCache()
+LONG_POLL_TIMEOUT = 25.0
+# maximum gain of a recording
+MAX_VOLUME = 4.0
+
+
+def get_state_response(info: str = ""):
+    _, state_dict, _ = state_cache.get()
+    return jsonify(dict(state_dict, info=info))
+
+
+@app.route("/metrics")
+def metrics_text():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/state")
 def state():
+    """
+    The current state. Supports If-None-Match and long polling with
+    ?since=<version>&boot=<boot>, which waits until a newer version is
+    available. Versions of another boot or from the future (e.g. before a
+    restart of the server) get the full state immediately. With websockets,
+    changes are pushed and long polls return immediately, so that they do not
+    block the workers of the websocket server.
+    """
     load()
-    return get_state_response()
+    since = request.args.get("since", None, type=int)
+    if request.args.get("boot", state_cache.boot) != state_cache.boot:
+        since = None
+    if since is not None and not websocket_support:
+        state_cache.wait(since, LONG_POLL_TIMEOUT)
+    version, _, body = state_cache.get()
+
+    etag = f"{state_cache.boot}-{version}"
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "no-cache",
+        # lets clients compensate the age of the cached document
+        "X-Stream-Frame": str(stream.frame_counter),
+    }
+    if etag in request.if_none_match or since == version:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
 
 
-@contextmanager
-def stream_context():
+def require_stream():
+    if stream.stream is None:
+        # wait for a restart of the stream
+        with stream.lock:
+            pass
     if stream.stream is None:
         abort(400, "No stream available")
-    stream.lock.acquire()
-    try:
-        yield
-    finally:
-        stream.lock.release()
 
 
-def get_recording(key, can_create=False):
-    if key in stream.recordings:
-        return stream.recordings[key]
-    elif can_create:
-        return stream.recordings[key]
-    else:
+def get_recording(key):
+    r = stream.get_recordings().get(key)
+    if r is None:
         abort(404, f"Recording with key '{key}' does not exist")
+    return r
 
 
-def delete_recording(key):
-    if key in stream.recordings:
-        del stream.recordings[key]
-    else:
+def get_timing():
+    """
+    Get the time of a transport command from the request arguments: either an
+    exact stream frame (?at=<frame>) or a quantization (?quantize=block|loop).
+    """
+    frame = request.args.get("at", None, type=int)
+    try:
+        quantize = Quantize(request.args.get("quantize", stream.default_quantize))
+    except ValueError as e:
+        abort(400, str(e))
+    return {"quantize": quantize, "frame": frame}
+
+
+def execute(op: Op, key=None, value=None, quantize=Quantize.Block, frame=None):
+    """
+    Applies a state change via the stream's command queue.
+    """
+    require_stream()
+    command = Command(op, key, value, quantize, frame)
+    try:
+        stream.execute(command)
+    except KeyError:
         abort(404, f"Recording with key '{key}' does not exist")
+    except ValueError as e:
+        abort(400, str(e))
+    except TimeoutError as e:
+        # the command has been dropped
+        abort(503, str(e))
+    state_cache.notify()
+    notify_when_applied(command)
+
+
+def notify_when_applied(command: Command):
+    """
+    Notify long polls when a scheduled command is applied, as the callback
+    cannot notify them itself.
+    """
+    if websocket_support or command.frame is None:
+        # websocket clients do not long poll
+        return
+    frames = command.frame - stream.frame_counter
+    if frames <= 0:
+        state_cache.notify()
+        return
+    # checks again until the callback passed the frame
+    applied = Timer(
+        max(frames / stream.stream.samplerate, 0.005), notify_when_applied, (command,)
+    )
+    applied.daemon = True
+    applied.start()
 
 
 @app.route("/delete/<string:key>")
 def delete(key):
-    with stream_context():
-        delete_recording(key)
+    execute(Op.Delete, key)
 
     e_changed_state()
     return get_state_response(f"Deleted {key}")
@@ -177,53 +375,249 @@ def delete(key):
 
 @app.route("/download/<string:key>")
 def download(key):
-    with stream_context():
-        r = get_recording(key)
-        bytes_io = r.create_bytes_io(stream.stream.samplerate)
-        bytes_io.seek(0)
-        time_str = datetime.fromtimestamp(r.timestamp).strftime("%Y_%m_%d-%H_%M")
-        return send_file(
-            bytes_io,
-            "audio/flac",
-            as_attachment=True,
-            download_name=f"{time_str}-{key}.flac",
+    require_stream()
+    format = request.args.get("format", "flac")
+    if format not in export.FORMATS:
+        abort(400, f"Unknown format '{format}'")
+    r = get_recording(key)
+    # the recording is encoded from its segments while it is sent, appends do
+    # not change them and overdubbing is rejected
+    try:
+        data = r.export(stream.stream.samplerate, format)
+    except ValueError as e:
+        abort(409, str(e))
+    time_str = datetime.fromtimestamp(r.timestamp).strftime("%Y_%m_%d-%H_%M")
+    response = Response(stream_with_context(data), mimetype=export.FORMATS[format])
+    response.headers.set(
+        "Content-Disposition",
+        "attachment",
+        **get_filename_options(f"{time_str}-{key}.{format}"),
+    )
+    return response
+
+
+def get_filename_options(filename: str) -> dict:
+    """
+    Get the options of a Content-Disposition header for a file name, which are
+    quoted when the header is dumped. Names that are not ASCII are added with
+    RFC 5987 encoding and an ASCII fallback, like werkzeug's send_file.
+    """
+    try:
+        filename.encode("ascii")
+        return {"filename": filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        # safe characters are RFC 5987 attr-char
+        quoted = quote(filename, safe="!#$&+-.^_`|~")
+        return {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+
+
+BATCH_OPS = [
+    Op.Record,
+    Op.Loop,
+    Op.Overdub,
+    Op.Pause,
+    Op.PauseAll,
+    Op.SetFrame,
+    Op.SetName,
+    Op.SetVolume,
+    Op.Delete,
+]
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    """
+    Applies a list of commands at the same frame, e.g.
+    [{"op": "loop", "key": "a"}, {"op": "record", "key": "b"}].
+    Either all or none of the commands are applied.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, list) or len(body) == 0:
+        abort(400, "Expected a non-empty list of commands")
+
+    keys = set(stream.get_recordings())
+    commands = []
+    for entry in body:
+        try:
+            op = Op(entry["op"])
+            key = None if op == Op.PauseAll else str(entry["key"])
+        except (KeyError, TypeError, ValueError):
+            abort(400, f"Invalid command {entry}")
+        if op not in BATCH_OPS:
+            abort(400, f"Operation {op.value} is not supported in batches")
+
+        value = entry.get("value", None)
+        if op == Op.Record and key not in keys:
+            # new recordings are created here to avoid allocations in the callback
+            value = stream.new_recording()
+            keys.add(key)
+        elif op == Op.Delete:
+            keys.discard(key)
+        elif op == Op.SetFrame and not isinstance(value, int):
+            abort(400, f"Invalid frame {value}")
+        elif op == Op.SetName:
+            value = str(value)
+        elif op == Op.SetVolume:
+            value = parse_volume(value)
+        commands.append(Command(op, key, value))
+
+    execute(Op.Batch, value=commands, **get_timing())
+
+    e_changed_state()
+    return get_state_response(f"Applied {len(commands)} commands")
+
+
+@app.route("/calibrate")
+def calibrate():
+    """
+    Measure the round-trip latency of the device by playing a chirp that has to
+    be picked up by the input (e.g. with a loopback cable). The result is saved
+    as record offset in the configuration and applied to new recordings.
+    """
+    require_stream()
+    try:
+        result = stream.calibrate_latency()
+    except ValueError as e:
+        abort(400, str(e))
+    stream.save_config_value("record-offset", round(result["seconds"], 6))
+
+    e_changed_state()
+    return get_state_response(
+        f"Measured a latency of {result['frames']} frames "
+        f"({1000 * result['seconds']:.1f} ms)"
+    )
+
+
+@app.route("/waveform/<string:key>")
+def waveform(key):
+    require_stream()
+    width = request.args.get("width", 512, type=int)
+    if width < 1:
+        abort(400, "Width must be positive")
+    format = request.args.get("format", "json")
+    if format not in ["json", "binary"]:
+        abort(400, f"Unknown format '{format}'")
+    try:
+        values, bin_frames = get_recording(key).waveform(width)
+    except ValueError as e:
+        abort(409, str(e))
+
+    if format == "binary":
+        # interleaved float32 min, max and rms of each bin
+        return Response(
+            values.astype("<f4").tobytes(),
+            mimetype="application/octet-stream",
+            headers={"X-Bin-Frames": str(bin_frames)},
         )
+    return jsonify(
+        {
+            "key": key,
+            "bin_frames": bin_frames,
+            "min": values[:, 0].tolist(),
+            "max": values[:, 1].tolist(),
+            "rms": values[:, 2].tolist(),
+        }
+    )
 
 
 @app.route("/record/<string:key>")
 def record(key):
-    with stream_context():
-        get_recording(key, can_create=True).state = State.Record
+    # new recordings are created here to avoid allocations in the callback
+    r = stream.get_recordings().get(key)
+    value = stream.new_recording() if r is None else None
+    execute(Op.Record, key, value, **get_timing())
 
     e_changed_state()
     return get_state_response(f"Start Recording at {key}")
 
 
+@app.route("/overdub/<string:key>")
+def overdub(key):
+    """
+    Add the input to a recording while it is played. Each overdub can be undone.
+    """
+    execute(Op.Overdub, key, **get_timing())
+
+    e_changed_state()
+    return get_state_response(f"Started overdubbing of {key}")
+
+
+@app.route("/undo/<string:key>")
+def undo(key):
+    execute(Op.Undo, key)
+
+    e_changed_state()
+    return get_state_response(f"Undid the last overdub of {key}")
+
+
+@app.route("/redo/<string:key>")
+def redo(key):
+    execute(Op.Redo, key)
+
+    e_changed_state()
+    return get_state_response(f"Redid the last overdub of {key}")
+
+
 @app.route("/set-frame/<string:key>/<int:frame>")
 def set_frame(key, frame):
-    with stream_context():
-        r = get_recording(key)
-        if r.state == State.Record:
-            abort(400, "Cannot set frame while recording")
-        r.set_frame(frame)
+    if get_recording(key).state in WRITING:
+        abort(400, "Cannot set frame while recording")
+    execute(Op.SetFrame, key, frame)
 
     e_changed_state()
     return get_state_response(f"Set frame of {key} to {frame}")
 
 
+@app.route("/trim/<string:key>/<int:start>/<int:end>")
+def trim(key, start, end):
+    """
+    Keep the frames [start, end) of a recording. The frames are not copied,
+    the memory of the other frames is released in the background.
+    """
+    if get_recording(key).state in WRITING:
+        abort(400, "Cannot trim while recording")
+    execute(Op.Trim, key, (start, end))
+
+    e_changed_state()
+    return get_state_response(f"Trimmed {key} to frames {start} to {end}")
+
+
 @app.route("/set-name/<string:key>/<string:name>")
 def set_name(key, name):
-    with stream_context():
-        get_recording(key).name = name
+    execute(Op.SetName, key, name)
 
     e_changed_state()
     return get_state_response(f"Set name of {key} to {name}")
 
 
+def parse_volume(value) -> float:
+    try:
+        volume = float(value)
+    except (TypeError, ValueError):
+        abort(400, f"Invalid volume {value}")
+    if not 0 <= volume <= MAX_VOLUME:
+        abort(400, f"Volume must be between 0 and {MAX_VOLUME}")
+    return volume
+
+
+@app.route("/set-volume/<string:key>/<string:volume>")
+def set_volume(key, volume):
+    """
+    Set the volume of a recording, e.g. /set-volume/a/0.5. The change is
+    applied with a short ramp.
+    """
+    volume = parse_volume(volume)
+    execute(Op.SetVolume, key, volume)
+
+    e_changed_state()
+    return get_state_response(f"Set volume of {key} to {volume}")
+
+
 @app.route("/pause/<string:key>")
 def pause(key):
-    with stream_context():
-        get_recording(key).state = State.Pause
+    execute(Op.Pause, key, **get_timing())
 
     e_changed_state()
     return get_state_response(f"Paused Recording at {key}")
@@ -231,9 +625,7 @@ def pause(key):
 
 @app.route("/pause")
 def pause_all():
-    with stream_context():
-        for r in stream.recordings.values():
-            r.state = State.Pause
+    execute(Op.PauseAll, **get_timing())
 
     e_changed_state()
     return get_state_response("Paused all recordings")
@@ -241,8 +633,8 @@ def pause_all():
 
 @app.route("/loop/<string:key>")
 def loop(key):
-    with stream_context():
-        get_recording(key).state = State.Loop
+    # recordings are decompressed or prefetched before they are played
+    execute(Op.Loop, key, **get_timing())
 
     e_changed_state()
     return get_state_response(f"Started looping of {key}")
@@ -1,20 +1,38 @@
 """
 Extends flask app with websockets to synchronize the state across clients.
+
+Changes are broadcast as deltas between versions of the cached state document
+with a single emit to all clients. Changes within a short window are coalesced
+into one delta, clients that have missed a version request the full state.
 """
 
 from slooper.app import app_flask
+from slooper.core import metrics
 import logging
+from threading import Lock
 from flask import request
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
 
 
 socketio = SocketIO(app_flask.app, logger=logging.getLogger(), engineio_logger=True)
 socketio_session_ids = []
 
+# all clients receive state deltas via this room
+STATE_ROOM = "state"
+# changes within this time (in seconds) are sent as one delta
+COALESCE_WINDOW = 0.05
+
+# version and state dict of the last broadcast
+broadcast_version = 0
+broadcast_state = {}
+broadcast_lock = Lock()
+broadcast_pending = False
+
 
 @socketio.on("connect")
 def connect():
     socketio_session_ids.append(request.sid)
+    join_room(STATE_ROOM)
     logging.info(f"SocketIO: Connect {request.sid} (total {len(socketio_session_ids)})")
 
 
@@ -26,21 +44,88 @@ def disconnect():
     )
 
 
-def broadcast_to_others(event, data, own_sid):
-    for c in socketio_session_ids:
-        if c != own_sid:
-            socketio.emit(event, data, room=c)
+def diff(old: dict, new: dict) -> dict:
+    """
+    Get the entries of new that differ from old.
+    """
+    return {k: v for k, v in new.items() if k not in old or old[k] != v}
+
+
+def get_delta(old_state: dict, new_state: dict) -> dict:
+    """
+    Get the changes between two state dicts.
+
+    :param old_state: the previous state
+    :param new_state: the current state
+    :return: changed stream info, changed fields of each recording and keys of
+             deleted recordings
+    """
+    old_recordings = old_state.get("recordings", {})
+    new_recordings = new_state["recordings"]
+    recordings = {}
+    for key, r in new_recordings.items():
+        changes = diff(old_recordings.get(key, {}), r)
+        if len(changes) > 0:
+            recordings[key] = changes
+    return {
+        "stream": diff(old_state.get("stream", {}), new_state["stream"]),
+        "recordings": recordings,
+        "deleted": [key for key in old_recordings if key not in new_recordings],
+    }
+
+
+def broadcast_delta():
+    """
+    Wait for further changes and broadcast the delta to the last broadcast.
+    """
+    global broadcast_version, broadcast_state, broadcast_pending
+    socketio.sleep(COALESCE_WINDOW)
+    with broadcast_lock:
+        broadcast_pending = False
+    # not locked, the cache schedules a broadcast when it refreshes statistics
+    version, state_dict, _ = app_flask.state_cache.get()
+    with broadcast_lock:
+        # a concurrent broadcast may have sent a newer version
+        if version > broadcast_version:
+            delta = get_delta(broadcast_state, state_dict)
+            delta["boot"] = app_flask.state_cache.boot
+            delta["version"] = version
+            delta["base"] = broadcast_version
+            socketio.emit("delta", delta, to=STATE_ROOM)
+            broadcast_version = version
+            broadcast_state = state_dict
+
+    if app_flask.stream.pending_scheduled() > 0:
+        # scheduled commands change the state later without notification
+        schedule_broadcast()
+
+
+def schedule_broadcast():
+    global broadcast_pending
+    with broadcast_lock:
+        if broadcast_pending:
+            return
+        broadcast_pending = True
+    socketio.start_background_task(broadcast_delta)
 
 
 def socketio_change_handler():
     """
-    Broadcasts the current state to other socketio_session_ids.
+    Broadcasts the changes of the state to all clients.
     """
-    sid = request.args.get("sid", None)
-    if sid is not None and sid != "":
-        state_dict = app_flask.get_state_dict("Client {sid} has modified the state")
-        broadcast_to_others("update", state_dict, sid)
+    schedule_broadcast()
+
+
+def collect_metrics():
+    return metrics.format_metric(
+        "slooper_websocket_clients",
+        "gauge",
+        "Number of connected websocket clients",
+        [({}, len(socketio_session_ids))],
+    )
+
 
+metrics.collectors.append(collect_metrics)
 
 # update state changed event handler
 app_flask.e_changed_state = socketio_change_handler
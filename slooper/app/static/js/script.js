@@ -27,12 +27,27 @@ function request_update() {
     }
 
     request_update.busy = true;
-    $.get("/state", getArgs, function (data) {
-        update(data);
-        request_update.busy = false;
-    }).fail(function () {
-        request_update.busy = false;
-    });
+    // only transfer the state if it has changed (ETag)
+    $.ajax({ url: "/state", data: getArgs, ifModified: true })
+        .done(function (data, status, xhr) {
+            if (status != "notmodified") {
+                update(data, getStateTime(data, xhr));
+            }
+            request_update.busy = false;
+        })
+        .fail(function () {
+            request_update.busy = false;
+        });
+}
+
+// the state may be cached by the server, get the time it has been created
+function getStateTime(data, xhr) {
+    const frame = Number(xhr.getResponseHeader("X-Stream-Frame"));
+    const samplerate = data.stream.samplerate;
+    if (!(samplerate > 0) || !(frame > data.stream.frame)) {
+        return new Date();
+    }
+    return new Date(Date.now() - ((frame - data.stream.frame) / samplerate) * 1000);
 }
 
 function update(data, time = new Date()) {
@@ -134,7 +149,8 @@ function updateRecordingsTable() {
             state.stream.duration_stats.std * 1000
         ).toFixed(2)} ms 
             (99p: ${(state.stream.duration_stats["99p"] * 1000).toFixed(2)},
-            max: ${(state.stream.duration_stats["max"] * 1000).toFixed(2)})
+            max: ${(state.stream.duration_stats["max"] * 1000).toFixed(2)},
+            peak: ${(state.stream.duration_stats.total["max"] * 1000).toFixed(2)})
         `);
     } else {
         $("#stream").html(`<b>not active</b>`);
@@ -374,13 +390,20 @@ function recordStart() {
         name = "";
     }
 
-    $.get("/record/" + key, getArgs, function (data) {
+    // start recording and set the name with a single request
+    var commands = [{ op: "record", key: key }];
+    if (name != "") {
+        commands.push({ op: "set-name", key: key, value: name });
+    }
+    $.ajax({
+        url: "/batch?" + getArgs,
+        type: "POST",
+        contentType: "application/json",
+        data: JSON.stringify(commands),
+    }).done(function (data) {
         // we started recording
         updateIsRecording(key);
         update(data);
-        if (name != "") {
-            $.get("/set-name/" + key + "/" + name);
-        }
     }).fail(function () {
         // recording failed, reset key
         updateIsRecording();
@@ -435,8 +458,34 @@ if (typeof io !== "undefined") {
     });
 
     // update the state when it is modified by others
-    socket.on("update", function (data) {
-        update(data);
+    socket.on("delta", function (delta) {
+        if (state == null || delta.boot != state.boot) {
+            // the server has been restarted, get the full state
+            request_update();
+            return;
+        }
+        if (delta.version <= state.version) {
+            // we already have this version
+            return;
+        }
+        if (delta.base != state.version) {
+            // we have missed a version, get the full state
+            request_update();
+            return;
+        }
+        var newState = Object.assign({}, state, {
+            boot: delta.boot,
+            version: delta.version,
+            stream: Object.assign({}, state.stream, delta.stream),
+            recordings: Object.assign({}, state.recordings),
+        });
+        for (const [key, changes] of Object.entries(delta.recordings)) {
+            newState.recordings[key] = Object.assign({}, state.recordings[key], changes);
+        }
+        for (const key of delta.deleted) {
+            delete newState.recordings[key];
+        }
+        update(newState);
     });
 }
 
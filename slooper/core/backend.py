@@ -0,0 +1,399 @@
+"""
+Audio backends that drive the stream callback.
+
+Besides sounddevice, there are backends that do not need any audio hardware:
+the null backend drives the callback from a timer thread and the file backend
+reads the input from a file and writes the output to another one.
+"""
+
+from abc import ABC, abstractmethod
+import logging
+import os
+from threading import Thread
+import time
+from typing import Callable, Optional, Tuple, Union
+
+import numpy as np
+
+
+class CallbackFlags:
+    """
+    Status flags of backends without PortAudio, mirrors sounddevice.CallbackFlags.
+    """
+
+    def __init__(self):
+        self.input_underflow = False
+        self.input_overflow = False
+        self.output_underflow = False
+        self.output_overflow = False
+        self.priming_output = False
+
+    def __bool__(self):
+        return any(vars(self).values())
+
+    def __repr__(self):
+        return ", ".join(name for name, value in vars(self).items() if value)
+
+
+class AudioBackend(ABC):
+    """
+    Audio stream that calls callback(data_in, data_out, frames, time, status)
+    for each block.
+    """
+
+    samplerate: float
+    device: Union[int, str, Tuple]
+    latency: Union[float, Tuple[float, float]]
+    blocksize: int
+
+    @property
+    @abstractmethod
+    def active(self) -> bool:
+        """
+        Whether the stream is running.
+        """
+        ...
+
+    @abstractmethod
+    def start(self):
+        """
+        Start calling the callback.
+        """
+        ...
+
+    @abstractmethod
+    def stop(self):
+        """
+        Stop calling the callback and wait until the current call has finished.
+        """
+        ...
+
+    def close(self):
+        """
+        Release all resources of the backend.
+        """
+        pass
+
+
+def set_realtime_priority(priority: int) -> bool:
+    """
+    Give the calling thread a real-time scheduling priority, if permitted.
+
+    :param priority: SCHED_FIFO priority (1-99)
+    :return: whether the priority has been set
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True
+    except (AttributeError, OSError) as e:
+        logging.warning(f"Could not set real-time priority: {e}")
+        return False
+
+
+def get_devices_list():
+    try:
+        import sounddevice as sd
+
+        return str(sd.query_devices()).split("\n")
+    except OSError as e:
+        return [f"sounddevice is not available: {e}"]
+
+
+def restart_sounddevice():
+    import sounddevice as sd
+
+    sd._terminate()
+    sd._initialize()
+
+
+def search_device(name: Union[int, str], kind: Optional[str] = None):
+    import sounddevice as sd
+
+    logging.info(f"Trying to find device containing '{name}' (kind {kind})")
+    try:
+        search_result = sd.query_devices(name, kind)
+        return search_result["name"]
+    except Exception:
+        raise ValueError(
+            f"Could not find device with name containing '{name}'.\n"
+            f"Available devices:\n {sd.query_devices()}"
+        )
+
+
+class SoundDeviceBackend(AudioBackend):
+    """
+    Audio stream of a sounddevice (PortAudio) device.
+    """
+
+    def __init__(
+        self,
+        callback: Callable,
+        device: Union[int, str, Tuple[Union[int, str], Union[int, str]]],
+        latency="high",
+        channels=1,
+        **kwargs,
+    ):
+        """
+        Open the stream.
+
+        :param callback: the stream callback
+        :param device: device id or (sub)string, or tuple of input and output device
+        :param latency: the latency of the stream
+        :param channels: number of channels
+        :param kwargs: further arguments for sounddevice.Stream
+        """
+        try:
+            import sounddevice as sd
+        except OSError as e:
+            raise ValueError(f"sounddevice is not available: {e}")
+
+        # restart sounddevice to reload available devices
+        restart_sounddevice()
+
+        if isinstance(device, (list, tuple)):
+            stream_device = (
+                search_device(device[0], kind="input"),
+                search_device(device[1], kind="output"),
+            )
+        else:
+            stream_device = (
+                search_device(device, kind="input"),
+                search_device(device, kind="output"),
+            )
+
+        logging.info("Using devices")
+        logging.info(f"> Input: {stream_device[0]}")
+        logging.info(f"> Output: {stream_device[1]}")
+
+        self.stream = sd.Stream(
+            callback=callback,
+            device=stream_device,
+            latency=latency,
+            channels=channels,
+            dtype="float32",
+            **kwargs,
+        )
+
+    @property
+    def active(self):
+        return self.stream.active
+
+    @property
+    def samplerate(self):
+        return self.stream.samplerate
+
+    @property
+    def device(self):
+        return self.stream.device
+
+    @property
+    def latency(self):
+        return self.stream.latency
+
+    @property
+    def blocksize(self):
+        return self.stream.blocksize
+
+    def start(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+
+    def close(self):
+        self.stream.close()
+
+
+class ThreadBackend(AudioBackend):
+    """
+    Calls the callback from a thread, either in real time or as fast as possible.
+    """
+
+    def __init__(
+        self,
+        callback: Callable,
+        samplerate: float = 48000,
+        blocksize: int = 256,
+        channels: int = 1,
+        realtime: bool = True,
+    ):
+        """
+        Initialize the backend.
+
+        :param callback: the stream callback
+        :param samplerate: the samplerate
+        :param blocksize: number of frames per block
+        :param channels: number of channels
+        :param realtime: whether to wait for the duration of each block
+        """
+        self.callback = callback
+        self.samplerate = float(samplerate)
+        self.blocksize = blocksize
+        self.latency = blocksize / self.samplerate
+        self.realtime = realtime
+        self.data_in = np.zeros((blocksize, channels), dtype=np.float32)
+        self.data_out = np.zeros((blocksize, channels), dtype=np.float32)
+        self.thread: Optional[Thread] = None
+        self.running = False
+
+    @property
+    def active(self):
+        return self.running
+
+    def read(self, data_in: np.ndarray) -> bool:
+        """
+        Fill the input of the next block.
+
+        :param data_in: the input block
+        :return: whether the stream should continue
+        """
+        return True
+
+    def write(self, data_out: np.ndarray):
+        """
+        Consume the output of a block.
+
+        :param data_out: the output block
+        """
+        pass
+
+    def run(self):
+        flags = CallbackFlags()
+        duration = self.blocksize / self.samplerate
+        deadline = time.perf_counter()
+        while self.running and self.read(self.data_in):
+            self.callback(self.data_in, self.data_out, self.blocksize, None, flags)
+            self.write(self.data_out)
+
+            if self.realtime:
+                deadline += duration
+                remaining = deadline - time.perf_counter()
+                # report missed deadlines like an audio device
+                flags.output_underflow = remaining < 0
+                if remaining > 0:
+                    time.sleep(remaining)
+                else:
+                    deadline = time.perf_counter()
+
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class NullBackend(ThreadBackend):
+    """
+    Silent input and discarded output, driven by a timer thread.
+    """
+
+    device = "null"
+
+
+class FileBackend(ThreadBackend):
+    """
+    Reads the input from an audio file and writes the output to another one.
+    """
+
+    def __init__(
+        self,
+        callback: Callable,
+        input: str,
+        output: Optional[str] = None,
+        blocksize: int = 256,
+        channels: int = 1,
+        realtime: bool = False,
+        loop_input: bool = False,
+    ):
+        """
+        Open the files.
+
+        :param callback: the stream callback
+        :param input: path of the input file, defines the samplerate
+        :param output: path of the output file, None to discard the output
+        :param blocksize: number of frames per block
+        :param channels: number of channels
+        :param realtime: whether to wait for the duration of each block
+        :param loop_input: whether to restart the input instead of stopping at its end
+        """
+        import soundfile as sf
+
+        self.input = sf.SoundFile(input)
+        super().__init__(callback, self.input.samplerate, blocksize, channels, realtime)
+        self.device = (input, output)
+        self.loop_input = loop_input
+        self.output = (
+            None
+            if output is None
+            else sf.SoundFile(
+                output,
+                "w",
+                samplerate=self.input.samplerate,
+                channels=channels,
+                subtype="FLOAT",
+            )
+        )
+        self.block = np.zeros((blocksize, self.input.channels), dtype=np.float32)
+
+    def read(self, data_in: np.ndarray) -> bool:
+        n = self.input.read(out=self.block)
+        if n.shape[0] < self.blocksize:
+            if not self.loop_input:
+                return False
+            self.input.seek(0)
+            self.input.read(out=self.block[n.shape[0] :])
+
+        # up- or downmix to the number of channels of the stream
+        if self.block.shape[1] == data_in.shape[1]:
+            data_in[:] = self.block
+        else:
+            data_in[:] = self.block.mean(axis=1, keepdims=True)
+        return True
+
+    def write(self, data_out: np.ndarray):
+        if self.output is not None:
+            self.output.write(data_out)
+
+    def close(self):
+        self.input.close()
+        if self.output is not None:
+            self.output.close()
+
+
+def create_backend(
+    name: str,
+    callback: Callable,
+    device: Union[int, str, Tuple[Union[int, str], Union[int, str]]],
+    latency="high",
+    channels=1,
+    **options,
+) -> AudioBackend:
+    """
+    Create an audio backend.
+
+    :param name: "sounddevice", "null" (or None) or "file"
+    :param callback: the stream callback
+    :param device: the device (only used by sounddevice)
+    :param latency: the latency (only used by sounddevice)
+    :param channels: number of channels
+    :param options: backend-specific arguments
+    :raises ValueError: if the backend cannot be created
+    :return: the backend
+    """
+    if name == "sounddevice":
+        return SoundDeviceBackend(callback, device, latency, channels, **options)
+    elif name == "null" or name is None:
+        # "backend: null" is parsed as None in yaml
+        return NullBackend(callback, channels=channels, **options)
+    elif name == "file":
+        return FileBackend(callback, channels=channels, **options)
+    raise ValueError(f"Unknown audio backend '{name}'")
@@ -0,0 +1,262 @@
+"""
+Offline benchmark of the stream callback.
+
+Drives stream.callback without audio hardware for a matrix of block sizes,
+samplerates, track counts, recording lengths and storage implementations, and
+reports callback latency percentiles, allocations per block and the real-time
+headroom. Results can be exported as JSON and compared between commits:
+
+    python -O -m slooper.core.benchmark --output new.json --compare old.json
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from timeit import default_timer as timer
+
+import numpy as np
+
+from slooper.core import stream
+from slooper.core.backend import CallbackFlags
+from slooper.core.command import Command, Op
+from slooper.core.mixer import Mixer
+from slooper.core.recording import Recording
+from slooper.core.vector import (
+    ChunkPool,
+    RingBlockArena,
+    RingGrowingArray,
+    RingSegmentList,
+)
+
+STORAGES = {
+    "segments": RingSegmentList,
+    "growing": lambda: RingGrowingArray(np.float32),
+    "arena": RingBlockArena,
+    "arena-float16": lambda: RingBlockArena(ChunkPool(dtype=np.float16)),
+    "arena-int16": lambda: RingBlockArena(ChunkPool(dtype=np.int16)),
+}
+
+
+def setup_recordings(storage, tracks, length, blocksize, channels, record, rng):
+    """
+    Replace all recordings of the stream with looping tracks.
+    """
+    stream.execute(Command(Op.Clear))
+    block = rng.uniform(-1, 1, (blocksize, channels)).astype(np.float32)
+    for i in range(tracks):
+        r = Recording(STORAGES[storage]())
+        for _ in range(max(1, length // blocksize)):
+            r.record(block)
+        stream.execute(Command(Op.Record, str(i), r))
+        stream.execute(Command(Op.Loop, str(i)))
+        # spread playback positions
+        stream.execute(Command(Op.SetFrame, str(i), int(rng.integers(len(r.data)))))
+
+    if record:
+        stream.execute(Command(Op.Record, "record", Recording(STORAGES[storage]())))
+
+
+def run_case(
+    storage, blocksize, samplerate, tracks, seconds, mixer, blocks, record, rng
+):
+    """
+    Benchmark a single configuration.
+
+    :return: dict with the parameters and results
+    """
+    channels = 1
+    stream.mixer = Mixer(channels=channels) if mixer else None
+    setup_recordings(
+        storage, tracks, int(seconds * samplerate), blocksize, channels, record, rng
+    )
+
+    data_in = rng.uniform(-1, 1, (blocksize, channels)).astype(np.float32)
+    data_out = np.zeros((blocksize, channels), dtype=np.float32)
+    flags = CallbackFlags()
+
+    # warm up (e.g. buffers that are allocated on first use)
+    for _ in range(min(blocks, 100)):
+        stream.callback(data_in, data_out, blocksize, None, flags)
+
+    durations = np.empty(blocks)
+    for i in range(blocks):
+        start = timer()
+        stream.callback(data_in, data_out, blocksize, None, flags)
+        durations[i] = timer() - start
+
+    # measure allocations separately as tracing slows down the callback
+    alloc_blocks = min(blocks, 200)
+    peak_bytes = np.empty(alloc_blocks)
+    allocated_blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    for i in range(alloc_blocks):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        stream.callback(data_in, data_out, blocksize, None, flags)
+        peak_bytes[i] = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    allocated_blocks = sys.getallocatedblocks() - allocated_blocks
+
+    block_duration = blocksize / samplerate
+    p99 = np.percentile(durations, 99).item()
+    return {
+        "storage": storage,
+        "blocksize": blocksize,
+        "samplerate": samplerate,
+        "tracks": tracks,
+        "seconds": seconds,
+        "mixer": mixer,
+        "record": record,
+        "latency": {
+            "mean": durations.mean().item(),
+            "p50": np.percentile(durations, 50).item(),
+            "p90": np.percentile(durations, 90).item(),
+            "p99": p99,
+            "p999": np.percentile(durations, 99.9).item(),
+            "max": durations.max().item(),
+        },
+        "alloc": {
+            "peak_bytes_mean": peak_bytes.mean().item(),
+            "peak_bytes_max": peak_bytes.max().item(),
+            "net_blocks_per_callback": allocated_blocks / alloc_blocks,
+        },
+        "headroom": {
+            "mean": block_duration / durations.mean().item(),
+            "p99": block_duration / p99,
+        },
+    }
+
+
+def case_key(result):
+    return tuple(
+        result[k]
+        for k in [
+            "storage",
+            "blocksize",
+            "samplerate",
+            "tracks",
+            "seconds",
+            "mixer",
+            "record",
+        ]
+    )
+
+
+def get_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return None
+
+
+def compare(results, baseline_results):
+    """
+    Print the change of latency and headroom relative to a baseline.
+    """
+    baseline = {case_key(r): r for r in baseline_results}
+    print("\nComparison with baseline (p99 latency ratio, >1 is slower)")
+    for r in results:
+        b = baseline.get(case_key(r))
+        if b is None:
+            continue
+        ratio = r["latency"]["p99"] / b["latency"]["p99"]
+        marker = " <- regression" if ratio > 1.1 else ""
+        print(f"{format_case(r):<60} {ratio:6.2f}{marker}")
+
+
+def format_case(r):
+    return (
+        f"{r['storage']:<13} bs={r['blocksize']:<5} sr={r['samplerate']:<6} "
+        f"tracks={r['tracks']:<3} len={r['seconds']:<4}s "
+        f"mixer={int(r['mixer'])} rec={int(r['record'])}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Slooper callback benchmark")
+    parser.add_argument("--storages", nargs="+", default=list(STORAGES))
+    parser.add_argument("--blocksizes", nargs="+", type=int, default=[64, 256, 1024])
+    parser.add_argument("--samplerates", nargs="+", type=int, default=[48000])
+    parser.add_argument("--tracks", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--seconds", nargs="+", type=float, default=[1, 30])
+    parser.add_argument(
+        "--mixer", nargs="+", type=int, default=[1, 0], help="1: vectorized mixer"
+    )
+    parser.add_argument(
+        "--record", action="store_true", help="record an additional track"
+    )
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="JSON output")
+    parser.add_argument("--compare", type=str, default=None, help="baseline JSON")
+    args = parser.parse_args()
+
+    if __debug__:
+        print("Warning: run with python -O to disable debug code in the callback")
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for case in itertools.product(
+        args.storages,
+        args.blocksizes,
+        args.samplerates,
+        args.tracks,
+        args.seconds,
+        args.mixer,
+    ):
+        storage, blocksize, samplerate, tracks, seconds, mixer = case
+        r = run_case(
+            storage,
+            blocksize,
+            samplerate,
+            tracks,
+            seconds,
+            bool(mixer),
+            args.blocks,
+            args.record,
+            rng,
+        )
+        results.append(r)
+        print(
+            f"{format_case(r)} "
+            f"p50={r['latency']['p50'] * 1e6:8.1f}us "
+            f"p99={r['latency']['p99'] * 1e6:8.1f}us "
+            f"max={r['latency']['max'] * 1e6:8.1f}us "
+            f"alloc={r['alloc']['peak_bytes_mean']:8.0f}B "
+            f"headroom={r['headroom']['p99']:7.1f}x"
+        )
+    stream.execute(Command(Op.Clear))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": get_commit(),
+                    "time": time.time(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
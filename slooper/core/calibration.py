@@ -0,0 +1,123 @@
+"""
+Measurement of the round-trip latency of the audio device.
+
+A chirp is played through the stream while the input is captured. The delay
+of the chirp in the input is found with a cross-correlation in the frequency
+domain and used as the offset between the input and the output of recordings.
+"""
+
+from threading import Event
+from typing import Tuple
+
+import numpy as np
+
+# duration of the chirp (in seconds)
+CHIRP_SECONDS = 0.5
+# amplitude of the chirp
+CHIRP_GAIN = 0.5
+# measurements with a lower normalized correlation are rejected
+MIN_CORRELATION = 0.1
+
+
+def chirp(samplerate: float, seconds: float = CHIRP_SECONDS) -> np.ndarray:
+    """
+    Create a linear sine sweep with faded edges.
+
+    :param samplerate: the samplerate
+    :param seconds: duration of the sweep
+    :return: float32 array of shape (frames,)
+    """
+    frames = int(seconds * samplerate)
+    t = np.arange(frames, dtype=np.float64) / samplerate
+    f0 = 100.0
+    f1 = min(8000.0, 0.4 * samplerate)
+    signal = np.sin(2 * np.pi * (f0 * t + (f1 - f0) / (2 * seconds) * t**2))
+    # short fades avoid clicks that correlate with any transient
+    edge = min(frames // 2, int(0.005 * samplerate))
+    if edge > 0:
+        window = np.hanning(2 * edge)
+        signal[:edge] *= window[:edge]
+        signal[-edge:] *= window[edge:]
+    return (CHIRP_GAIN * signal).astype(np.float32)
+
+
+def find_delay(
+    signal: np.ndarray, captured: np.ndarray, max_delay: int
+) -> Tuple[int, float]:
+    """
+    Find the delay of a signal in the captured input.
+
+    :param signal: array of shape (frames,)
+    :param captured: array of shape (frames, channels), the channels are
+                     mixed down before they are correlated
+    :param max_delay: maximum delay in frames
+    :return: delay in frames and the normalized correlation at the delay
+    """
+    # the correlation and its norm of the same mono signal stay within [0, 1]
+    mono = captured.mean(axis=1)
+    n = signal.shape[0] + mono.shape[0]
+    size = 1 << (n - 1).bit_length()
+    spectrum = np.fft.rfft(signal, size)
+    mono_spectrum = np.fft.rfft(mono, size)
+    # correlation for all non-negative lags
+    correlation = np.fft.irfft(mono_spectrum * np.conj(spectrum), size)
+    correlation = correlation[: max_delay + 1]
+    delay = int(np.argmax(np.abs(correlation)))
+
+    # energy of the captured frames that overlap the signal at the delay
+    window = mono[delay : delay + signal.shape[0]]
+    norm = np.linalg.norm(signal) * np.linalg.norm(window)
+    if norm == 0:
+        return delay, 0.0
+    return delay, float(abs(correlation[delay]) / norm)
+
+
+class Calibration:
+    """
+    Plays a signal and captures the input of the stream callback, without
+    allocations in the callback.
+    """
+
+    def __init__(self, signal: np.ndarray, max_delay: int, channels: int = 1):
+        """
+        Initialize the calibration.
+
+        :param signal: the signal of shape (frames,)
+        :param max_delay: number of frames that are captured after the signal
+        :param channels: number of channels of the stream
+        """
+        self.signal = signal.reshape(-1, 1)
+        self.max_delay = max_delay
+        self.captured = np.zeros(
+            (signal.shape[0] + max_delay, channels), dtype=np.float32
+        )
+        self.pos = 0
+        self.done = Event()
+
+    def process(self, data_in: np.ndarray, data_out: np.ndarray):
+        """
+        Replace the output with the signal and capture the input (callback).
+
+        :param data_in: input of shape (frames, channels)
+        :param data_out: output of shape (frames, channels)
+        """
+        pos = self.pos
+        n = min(data_in.shape[0], self.captured.shape[0] - pos)
+        if n <= 0:
+            return
+        self.captured[pos : pos + n] = data_in[:n]
+        data_out.fill(0)
+        m = min(n, self.signal.shape[0] - pos)
+        if m > 0:
+            data_out[:m] = self.signal[pos : pos + m]
+        self.pos = pos + n
+        if self.pos == self.captured.shape[0]:
+            self.done.set()
+
+    def result(self) -> Tuple[int, float]:
+        """
+        Get the measured round-trip latency.
+
+        :return: latency in frames and the normalized correlation
+        """
+        return find_delay(self.signal[:, 0], self.captured, self.max_delay)
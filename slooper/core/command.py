@@ -0,0 +1,133 @@
+"""
+Commands that change the state of the recordings.
+
+HTTP handlers do not modify recordings directly. They post commands to a queue
+that is drained by the audio callback at the beginning of each block, so the
+real-time thread never has to wait for the web server. Commands can also be
+scheduled for an exact frame of the stream, e.g. the next seam of the master
+loop.
+"""
+
+from collections import deque
+from enum import Enum
+from itertools import count
+from threading import Event, Lock
+from typing import Any, Optional
+
+
+class Op(Enum):
+    Record = "record"
+    Loop = "loop"
+    Overdub = "overdub"
+    Pause = "pause"
+    PauseAll = "pause-all"
+    SetFrame = "set-frame"
+    SetName = "set-name"
+    SetVolume = "set-volume"
+    SetData = "set-data"
+    Trim = "trim"
+    Undo = "undo"
+    Redo = "redo"
+    Delete = "delete"
+    Clear = "clear"
+    Restore = "restore"
+    # list of commands that are applied together
+    Batch = "batch"
+
+
+class Quantize(Enum):
+    # at the beginning of the next block
+    Block = "block"
+    # at the next seam of the master loop
+    Loop = "loop"
+
+
+# tie breaker for commands that are scheduled at the same frame
+_sequence = count()
+
+
+class Command:
+    """
+    A single state change for the recording with the given key.
+    """
+
+    def __init__(
+        self,
+        op: Op,
+        key: Optional[str] = None,
+        value: Any = None,
+        quantize: Quantize = Quantize.Block,
+        frame: Optional[int] = None,
+    ):
+        """
+        Create a new command.
+
+        :param op: the operation
+        :param key: key of the affected recording (if any)
+        :param value: the argument of the operation (if any)
+        :param quantize: when the command is applied if frame is None
+        :param frame: stream frame at which the command is applied, None to
+                      quantize the current frame
+        """
+        self.op = op
+        self.key = key
+        self.value = value
+        self.quantize = quantize
+        self.frame = frame
+        self.seq = next(_sequence)
+        self.error: Optional[Exception] = None
+        self.done = Event()
+        # taken by the consumer to apply the command or by the producer to
+        # cancel it, whichever comes first
+        self._claim = Lock()
+
+    def claim(self) -> bool:
+        """
+        Take the command to apply or to cancel it, without blocking.
+
+        :return: whether the command has not been taken before
+        """
+        return self._claim.acquire(False)
+
+    def __lt__(self, other: "Command"):
+        # order of scheduled commands
+        if self.frame != other.frame:
+            return self.frame < other.frame
+        return self.seq < other.seq
+
+    def __repr__(self):
+        return f"Command({self.op.value}, {self.key}, {self.value})"
+
+
+class CommandQueue:
+    """
+    Queue of commands with non-blocking access for the consumer.
+
+    Relies on the atomicity of deque.append and deque.popleft, so neither the
+    producers nor the consumer have to acquire a lock.
+    """
+
+    def __init__(self):
+        self._queue = deque()
+
+    def put(self, command: Command):
+        """
+        Add a command to the end of the queue.
+
+        :param command: the command
+        """
+        self._queue.append(command)
+
+    def get(self) -> Optional[Command]:
+        """
+        Remove the first command from the queue without blocking.
+
+        :return: the first command or None if the queue is empty
+        """
+        try:
+            return self._queue.popleft()
+        except IndexError:
+            return None
+
+    def __len__(self):
+        return len(self._queue)
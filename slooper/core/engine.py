@@ -0,0 +1,571 @@
+"""
+Audio engine in a separate process.
+
+The engine process runs slooper.core.stream with its own interpreter, so
+requests of the web app (JSON serialization, encoding of downloads) do not
+compete with the callback for the GIL. Recordings are stored in shared memory
+chunks, the front end attaches to them to read audio without involving the
+engine. Commands and telemetry (versions, stream info and the layout of all
+recordings) are exchanged via a pipe.
+
+EngineClient provides the part of the interface of slooper.core.stream that is
+used by the web app, so it can be used in place of the module.
+"""
+
+import atexit
+import logging
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import signal
+from threading import Lock
+from timeit import default_timer as timer
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+from slooper.core import metrics
+import slooper.core.stream as stream
+from slooper.core.command import Command, Op, Quantize
+from slooper.core.recording import Recording, State
+from slooper.core.vector import (
+    RingAccessVector,
+    RingBlockArena,
+    RingCompressedArray,
+    RingFileArray,
+    SharedChunkPool,
+    window_segments,
+)
+
+# real-time priority of the callback thread in the engine process
+CALLBACK_PRIORITY = 70
+# interval of the maintenance of the shared memory pool in seconds
+MAINTENANCE_INTERVAL = 0.05
+# maximum number of waveform bins of recordings that are published while recording
+PUBLISHED_BINS = 2048
+
+
+def encode_command(command: Command) -> tuple:
+    """
+    Convert a command to a tuple that can be sent to the engine. Recordings
+    that would be created by the command are created by the engine instead.
+    """
+    value = command.value
+    if command.op == Op.Batch:
+        value = [encode_command(c) for c in value]
+    new = isinstance(value, Recording)
+    if new:
+        value = None
+    return (command.op, command.key, value, command.quantize, command.frame, new)
+
+
+def decode_command(encoded: tuple, pool: SharedChunkPool) -> Command:
+    op, key, value, quantize, frame, new = encoded
+    if op == Op.Batch:
+        value = [decode_command(c, pool) for c in value]
+    elif new:
+        value = Recording(RingBlockArena(pool))
+    return Command(op, key, value, quantize, frame)
+
+
+def describe_storage(data: RingAccessVector) -> Optional[dict]:
+    """
+    Get the layout of a storage, so that other processes can read it.
+
+    :return: dict with the layout or None if it is not shared
+    """
+    if isinstance(data, RingFileArray):
+        size = data.size
+        start, end = data.window(size)
+        return {
+            "path": data.path,
+            "size": size,
+            "start": start,
+            "end": end,
+            "channels": data.channels,
+            "dtype": data.dtype.str,
+            "scale": data.scale,
+            "nbytes": data.nbytes,
+        }
+    if isinstance(data, RingBlockArena) and isinstance(data.pool, SharedChunkPool):
+        # read the size first as the chunks are acquired before it is increased
+        size = data.size
+        chunks = list(data.chunks)
+        start, end = data.window(size)
+        return {
+            "chunks": [data.pool.name(chunk) for chunk in chunks],
+            "chunk_size": data.pool.chunk_size,
+            "size": size,
+            "start": start,
+            "end": end,
+            "channels": chunks[0].shape[1] if len(chunks) > 0 else 1,
+            "dtype": np.dtype(data.pool.dtype).str,
+            "scale": data.scale,
+            "nbytes": data.nbytes,
+            "history": data.history,
+        }
+    if isinstance(data, RingCompressedArray):
+        # only the length is known to other processes
+        return {
+            "compressed": True,
+            "size": len(data),
+            "start": 0,
+            "end": len(data),
+            "channels": data.channels,
+            "dtype": data.dtype.str,
+            "scale": data.scale,
+            "nbytes": data.nbytes,
+        }
+    return None
+
+
+def get_telemetry() -> dict:
+    """
+    Get the state of the engine.
+    """
+    active = stream.stream is not None and stream.stream.active
+    return {
+        "version": stream.state_version,
+        "frame": stream.frame_counter,
+        "scheduled": stream.pending_scheduled(),
+        "running": stream.stream is not None,
+        "active": active,
+        "samplerate": 0 if stream.stream is None else stream.stream.samplerate,
+        "device": -1 if stream.stream is None else stream.stream.device,
+        "info": stream.get_stream_info_dict(),
+        "recordings": {
+            key: {
+                "info": r.get_info_dict(),
+                "timestamp": r.timestamp,
+                "revision": r.revision,
+                "storage": describe_storage(r.data),
+                # the waveform is only computed from the data after recording
+                "peaks": (
+                    r.peaks.get_levels(PUBLISHED_BINS)
+                    if r.state == State.Record
+                    else None
+                ),
+            }
+            for key, r in stream.get_recordings().items()
+        },
+    }
+
+
+def run_engine(conn, options: dict):
+    """
+    Main function of the engine process.
+
+    :param conn: pipe to the front end
+    :param options: arguments of stream_start
+    """
+    logging.basicConfig(
+        format="[%(asctime)s] engine %(levelname)s > %(message)s", level=logging.INFO
+    )
+    # the front end decides when to stop (and save the session)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    if options.get("storage_kind", "arena") != "arena":
+        # other processes can only read chunks in shared memory
+        logging.warning("The engine process stores recordings in an arena")
+        options["storage_kind"] = "arena"
+    precision = options.get("storage_precision", "float32")
+    pool = SharedChunkPool(
+        dtype=stream.PRECISIONS.get(precision, np.float32),
+        channels=options.get("channels", 1),
+    )
+    pool.refill()
+    # new recordings use chunks in shared memory
+    stream.storage_pool = pool
+    stream.callback_priority = CALLBACK_PRIORITY
+    try:
+        stream.stream_start(**options)
+    except Exception as e:
+        pool.close()
+        conn.send(("error", e))
+        return
+    conn.send(("ok", get_telemetry()))
+
+    try:
+        maintenance = timer()
+        while True:
+            # also runs while requests arrive without pause
+            if timer() >= maintenance:
+                pool.refill()
+                pool.collect()
+                maintenance = timer() + MAINTENANCE_INTERVAL
+            if not conn.poll(max(0.0, maintenance - timer())):
+                continue
+
+            request = conn.recv()
+            kind = request[0]
+            if kind == "execute":
+                command = decode_command(request[1], pool)
+                try:
+                    stream.execute(command, request[2])
+                    # the frame of scheduled commands
+                    conn.send(("ok", command.frame, get_telemetry()))
+                except Exception as e:
+                    conn.send(("error", e, get_telemetry()))
+            elif kind == "telemetry":
+                conn.send(("ok", get_telemetry()))
+            elif kind == "calibrate":
+                try:
+                    conn.send(("ok", stream.calibrate_latency(*request[1:])))
+                except Exception as e:
+                    conn.send(("error", e))
+            elif kind == "metrics":
+                # without locks, they are reported by the front end
+                conn.send(("ok", metrics.collect()))
+            elif kind == "close":
+                break
+    except (EOFError, OSError):
+        logging.error("Lost connection to the front end")
+    finally:
+        stream.stream_close()
+        stream.execute(Command(Op.Clear))
+        pool.close()
+    try:
+        conn.send(("ok", None))
+    except OSError:
+        pass
+
+
+class SharedView(RingAccessVector):
+    """
+    Read-only view of a recording of the engine process.
+    """
+
+    def __init__(self, client: "EngineClient", storage: Optional[dict]):
+        self.client = client
+        self.storage = storage
+
+    @property
+    def scale(self):
+        return 1.0 if self.storage is None else self.storage["scale"]
+
+    def segments(self):
+        storage = self.storage
+        if storage is None or storage["size"] == 0:
+            return [np.empty((0, 1), dtype=np.float32)]
+
+        if storage.get("compressed", False):
+            raise ValueError("Compressed recordings have to be looped before reading")
+
+        shape = (storage["size"], storage["channels"])
+        dtype = np.dtype(storage["dtype"])
+        if "path" in storage:
+            data = np.memmap(storage["path"], dtype, mode="r", shape=shape)
+            return [data[storage["start"] : storage["end"]]]
+
+        chunk_size = storage["chunk_size"]
+        segments = []
+        for i, name in enumerate(storage["chunks"]):
+            n = min(chunk_size, shape[0] - i * chunk_size)
+            if n <= 0:
+                break
+            chunk = np.ndarray(
+                (chunk_size, shape[1]),
+                dtype=dtype,
+                buffer=self.client.attach(name).buf,
+            )
+            segments.append(chunk[:n])
+        return window_segments(segments, storage["start"], storage["end"])
+
+    def numpy(self):
+        return np.concatenate(self.segments())
+
+    def set_idx(self, idx):
+        raise ValueError("Recordings of the engine are read-only")
+
+    def append(self, x):
+        raise ValueError("Recordings of the engine are read-only")
+
+    def take(self, n):
+        raise ValueError("Recordings of the engine are read-only")
+
+    def clear(self):
+        raise ValueError("Recordings of the engine are read-only")
+
+    def close(self):
+        pass
+
+    @property
+    def history(self):
+        if self.storage is None:
+            return 0, 0
+        return tuple(self.storage.get("history", (0, 0)))
+
+    @property
+    def nbytes(self):
+        # memory of the storage in the engine process
+        return 0 if self.storage is None else self.storage["nbytes"]
+
+    def __len__(self):
+        if self.storage is None:
+            return 0
+        return self.storage["end"] - self.storage["start"]
+
+
+class EngineStream:
+    """
+    Properties of the stream of the engine process.
+    """
+
+    def __init__(self, client: "EngineClient"):
+        self.client = client
+
+    @property
+    def active(self):
+        return self.client.get_telemetry()["active"]
+
+    @property
+    def samplerate(self):
+        return self.client.get_telemetry()["samplerate"]
+
+    @property
+    def device(self):
+        return self.client.get_telemetry()["device"]
+
+
+class EngineClient:
+    """
+    Front end of the engine process, provides the interface of
+    slooper.core.stream that is used by the web app.
+    """
+
+    def __init__(self, max_age: float = 0.02):
+        """
+        Initialize the client, the engine is started by stream_start.
+
+        :param max_age: maximum age of the telemetry in seconds before it is
+                        requested again
+        """
+        self.max_age = max_age
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn = None
+        self.conn_lock = Lock()
+        self.lock = metrics.TimedLock()
+        self.default_quantize = Quantize.Block
+        self.telemetry: dict = {}
+        self.telemetry_time = -float("inf")
+        self.recordings: Dict[str, Recording] = {}
+        self.attached: Dict[str, SharedMemory] = {}
+        self._stream = EngineStream(self)
+        self.load_config = stream.load_config
+        self.save_config_value = stream.save_config_value
+        # stop the engine (and save the session) at exit
+        atexit.register(self.stream_close)
+
+    @property
+    def stream(self) -> Optional[EngineStream]:
+        return None if self.conn is None else self._stream
+
+    def _request(self, request: tuple):
+        with self.conn_lock:
+            if self.conn is None:
+                raise ValueError("The engine is not running")
+            try:
+                self.conn.send(request)
+                return self.conn.recv()
+            except (EOFError, OSError):
+                logging.error("The engine process has terminated")
+                self._shutdown()
+                raise ValueError("The engine process has terminated")
+
+    def _update(self, telemetry: dict):
+        recordings = {}
+        for key, entry in telemetry["recordings"].items():
+            storage = entry["storage"]
+            r = self.recordings.get(key)
+            if r is None or get_storage_id(r.data.storage) != get_storage_id(storage):
+                r = Recording(SharedView(self, storage))
+            r.data.storage = storage
+            info = entry["info"]
+            r.state = State(info["state"])
+            r.frame = info["frame"]
+            r.volume = info["volume"]
+            r.name = info["name"]
+            r.timestamp = entry["timestamp"]
+            if r.revision != entry["revision"]:
+                # the data has been overdubbed, the waveform is outdated
+                r.revision = entry["revision"]
+                r.peaks.clear()
+            if entry["peaks"] is not None:
+                # the waveform while recording
+                r.peaks.set_levels(entry["peaks"])
+            recordings[key] = r
+        self.recordings = recordings
+        self.telemetry = telemetry
+        self.telemetry_time = timer()
+
+        # detach from blocks that have been removed by the engine
+        names = set()
+        for entry in telemetry["recordings"].values():
+            names.update((entry["storage"] or {}).get("chunks", []))
+        for name in [name for name in self.attached if name not in names]:
+            try:
+                self.attached[name].close()
+                del self.attached[name]
+            except BufferError:
+                # still referenced by a download
+                pass
+
+    def get_telemetry(self) -> dict:
+        if self.conn is not None and timer() - self.telemetry_time > self.max_age:
+            try:
+                self._update(self._request(("telemetry",))[1])
+            except ValueError:
+                pass
+        return self.telemetry
+
+    def attach(self, name: str) -> SharedMemory:
+        """
+        Get a shared memory block of the engine.
+
+        :param name: name of the block
+        :return: the block
+        """
+        block = self.attached.get(name)
+        if block is None:
+            block = SharedMemory(name=name)
+            self.attached[name] = block
+        return block
+
+    @property
+    def state_version(self) -> int:
+        return self.get_telemetry().get("version", 0)
+
+    @property
+    def frame_counter(self) -> int:
+        return self.get_telemetry().get("frame", 0)
+
+    def pending_scheduled(self) -> int:
+        return self.get_telemetry().get("scheduled", 0)
+
+    def get_recordings(self) -> Dict[str, Recording]:
+        self.get_telemetry()
+        return self.recordings
+
+    def new_recording(self) -> Recording:
+        # only a placeholder, the recording is created by the engine
+        return Recording()
+
+    def get_stream_info_dict(self):
+        if self.conn is None:
+            return {
+                "active": False,
+                "samplerate": 0,
+                "device": -1,
+                "duration_stats": stream.duration_stats.get_stats(),
+                "debug": stream.get_devices_list(),
+            }
+        return self.get_telemetry()["info"]
+
+    def execute(self, command: Command, timeout: float = 1.0):
+        """
+        Execute a command in the engine, see slooper.core.stream.execute.
+        """
+        if self.conn is None:
+            # all recordings are discarded with the engine
+            return
+        reply = self._request(("execute", encode_command(command), timeout))
+        self._update(reply[-1])
+        if reply[0] == "error":
+            raise reply[1]
+        command.frame = reply[1]
+
+    def calibrate_latency(self, max_delay_seconds: float = 1.0) -> dict:
+        """
+        Measure the round-trip latency in the engine, see
+        slooper.core.stream.calibrate_latency.
+        """
+        if self.conn is None:
+            raise ValueError("The stream is not running")
+        reply = self._request(("calibrate", max_delay_seconds))
+        if reply[0] == "error":
+            raise ValueError(reply[1])
+        return reply[1]
+
+    def collect_metrics(self) -> str:
+        try:
+            return self._request(("metrics",))[1]
+        except ValueError:
+            return ""
+
+    def stream_start(self, quantize: Union[str, Quantize] = Quantize.Block, **options):
+        """
+        Start the engine process, see slooper.core.stream.stream_start.
+
+        :raises ValueError: if the stream cannot be started
+        """
+        if self.conn is not None:
+            return
+        self.default_quantize = Quantize(quantize)
+        options["quantize"] = quantize
+
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_engine, args=(child_conn, options), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        try:
+            reply = self.conn.recv()
+        except EOFError:
+            reply = ("error", "the engine process has terminated")
+        if reply[0] == "error":
+            self._shutdown()
+            raise ValueError(f"Could not start the engine: {reply[1]}")
+        self._update(reply[1])
+
+        # the metrics of the stream are collected in the engine process
+        if stream.collect_metrics in metrics.collectors:
+            metrics.collectors.remove(stream.collect_metrics)
+            metrics.collectors.append(self.collect_metrics)
+        logging.info(f"Started engine process {self.process.pid}")
+
+    def stream_close(self):
+        """
+        Stop the engine process, it saves the session before.
+        """
+        if self.conn is None:
+            return
+        try:
+            self._request(("close",))
+        except ValueError:
+            pass
+        self._shutdown()
+        logging.info("Closed engine process")
+
+    def _shutdown(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            self.process = None
+        self.recordings = {}
+        self.telemetry = {}
+        self.telemetry_time = -float("inf")
+        for block in self.attached.values():
+            try:
+                block.close()
+            except BufferError:
+                # still referenced by a download
+                pass
+        self.attached = {}
+
+
+def get_storage_id(storage: Optional[dict]) -> Optional[str]:
+    """
+    Identify a storage of the engine, changes if the data has been replaced.
+    """
+    if storage is None:
+        return None
+    if "path" in storage:
+        return storage["path"]
+    if storage.get("compressed", False):
+        return "compressed"
+    chunks: List[str] = storage["chunks"]
+    return chunks[0] if len(chunks) > 0 else None
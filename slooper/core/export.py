@@ -0,0 +1,167 @@
+"""
+Incremental encoding of recordings for streaming downloads.
+"""
+
+import io
+import struct
+from typing import Iterator, List
+
+import numpy as np
+import soundfile as sf
+from slooper.core.vector import to_float32
+
+
+FORMATS = {"flac": "audio/flac", "wav": "audio/wav"}
+
+
+def split(
+    segments: List[np.ndarray], frames: int = 1 << 14, scale: float = 1.0
+) -> Iterator[np.ndarray]:
+    """
+    Split segments into blocks with a maximum number of frames.
+
+    :param segments: list of arrays with shape (frames, channels)
+    :param frames: maximum number of frames per block
+    :param scale: value of one element of the segments
+    :return: iterator over views of float32 segments, other blocks are converted
+    """
+    for segment in segments:
+        for i in range(0, segment.shape[0], frames):
+            yield to_float32(segment[i : i + frames], scale)
+
+
+class StreamSink(io.RawIOBase):
+    """
+    Write-only file object that hands out written bytes as soon as possible.
+
+    Encoders may seek back to update their headers when they are closed. Bytes
+    that have already been handed out cannot be changed anymore, so these
+    updates are dropped.
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+        self.offset = 0
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, b):
+        n = len(b)
+        start = self.pos - self.offset
+        if start < 0:
+            # drop updates of bytes that have already been handed out
+            b = memoryview(b)[-start:]
+            start = 0
+        if start > len(self.pending):
+            self.pending.extend(bytes(start - len(self.pending)))
+        self.pending[start : start + len(b)] = b
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.offset + len(self.pending) + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def take(self) -> bytes:
+        """
+        Get all pending bytes.
+
+        :return: the bytes that have been written since the last call
+        """
+        data = bytes(self.pending)
+        self.offset += len(self.pending)
+        self.pending.clear()
+        return data
+
+
+def stream_flac(
+    segments: List[np.ndarray],
+    samplerate: int,
+    chunk_bytes: int = 1 << 16,
+    scale: float = 1.0,
+) -> Iterator[bytes]:
+    """
+    Encode segments as FLAC file.
+
+    :param segments: list of arrays with shape (frames, channels)
+    :param samplerate: the samplerate
+    :param chunk_bytes: minimum number of bytes per yielded chunk
+    :param scale: value of one element of the segments
+    :return: iterator over the bytes of the file
+    """
+    channels = segments[0].shape[1] if len(segments) > 0 else 1
+    sink = StreamSink()
+    with sf.SoundFile(
+        sink, "w", samplerate=samplerate, channels=channels, format="FLAC"
+    ) as f:
+        for block in split(segments, scale=scale):
+            f.write(block)
+            if len(sink.pending) >= chunk_bytes:
+                yield sink.take()
+    yield sink.take()
+
+
+def wav_header(frames: int, samplerate: int, channels: int) -> bytes:
+    """
+    Create the header of a 32-bit float WAV file.
+
+    :param frames: total number of frames
+    :param samplerate: the samplerate
+    :param channels: number of channels
+    :return: the header bytes
+    """
+    block_align = 4 * channels
+    data_size = frames * block_align
+    riff = struct.pack("<4sI4s", b"RIFF", 36 + data_size, b"WAVE")
+    fmt = struct.pack(
+        "<4sIHHIIHH",
+        b"fmt ",
+        16,
+        3,  # IEEE float
+        channels,
+        samplerate,
+        samplerate * block_align,
+        block_align,
+        32,
+    )
+    data = struct.pack("<4sI", b"data", data_size)
+    return riff + fmt + data
+
+
+def stream_wav(
+    segments: List[np.ndarray],
+    samplerate: int,
+    chunk_bytes: int = 1 << 16,
+    scale: float = 1.0,
+) -> Iterator[bytes]:
+    """
+    Encode segments as 32-bit float WAV file.
+
+    :param segments: list of arrays with shape (frames, channels)
+    :param samplerate: the samplerate
+    :param chunk_bytes: minimum number of bytes per yielded chunk
+    :param scale: value of one element of the segments
+    :return: iterator over the bytes of the file
+    """
+    channels = segments[0].shape[1] if len(segments) > 0 else 1
+    frames = sum(segment.shape[0] for segment in segments)
+    buffer = bytearray(wav_header(frames, samplerate, channels))
+    for block in split(segments, scale=scale):
+        buffer += block.astype("<f4", copy=False).tobytes()
+        if len(buffer) >= chunk_bytes:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer)
@@ -0,0 +1,66 @@
+"""
+Precomputed fade curves for click-free loop seams and volume changes.
+
+Tables are computed once per length and cached, so the callback only looks
+them up. They are read-only as they are shared by all recordings.
+"""
+
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+
+# length of the crossfade at the seam of a loop (in frames)
+SEAM_FRAMES = 512
+# duration of a volume change (in frames)
+RAMP_FRAMES = 1024
+
+
+@lru_cache(maxsize=None)
+def crossfade(frames: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get an equal-power crossfade.
+
+    :param frames: length of the crossfade
+    :return: fade out and fade in curves of shape (frames, 1)
+    """
+    t = (np.arange(frames, dtype=np.float64) + 0.5) / frames * (np.pi / 2)
+    fade_out = np.cos(t).astype(np.float32).reshape(-1, 1)
+    fade_in = np.sin(t).astype(np.float32).reshape(-1, 1)
+    fade_out.setflags(write=False)
+    fade_in.setflags(write=False)
+    return fade_out, fade_in
+
+
+@lru_cache(maxsize=None)
+def ramp(frames: int) -> np.ndarray:
+    """
+    Get a linear ramp for a block, it ends with 1 at the last frame.
+
+    :param frames: the block size
+    :return: ramp of shape (frames, 1)
+    """
+    table = (np.arange(1, frames + 1, dtype=np.float32) / frames).reshape(-1, 1)
+    table.setflags(write=False)
+    return table
+
+
+def apply_ramp(
+    block: np.ndarray, start: float, end: float, scratch: Optional[np.ndarray]
+) -> np.ndarray:
+    """
+    Multiply a block with a gain that changes linearly within the block.
+
+    :param block: float32 array of shape (frames, channels), modified in place
+    :param start: gain before the first frame
+    :param end: gain at the last frame
+    :param scratch: buffer for the gains from a previous call or None
+    :return: the buffer, it is only reallocated if the block size has changed
+    """
+    frames = block.shape[0]
+    if scratch is None or scratch.shape[0] != frames:
+        scratch = np.empty((frames, 1), dtype=np.float32)
+    np.multiply(ramp(frames), end - start, out=scratch)
+    scratch += start
+    block *= scratch
+    return scratch
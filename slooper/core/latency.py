@@ -0,0 +1,108 @@
+"""
+Adaptive latency of the stream.
+
+The controller periodically looks at the xruns and the callback durations of
+the stream. It lowers the latency while the callback has enough headroom and
+raises it again after repeated xruns, latencies that have caused xruns are not
+tried again.
+"""
+
+from typing import Optional
+
+# status flags of the callback that indicate dropped or missing frames
+XRUN_FLAGS = [
+    "input_underflow",
+    "input_overflow",
+    "output_underflow",
+    "output_overflow",
+]
+
+
+class LatencyController:
+    """
+    Decides whether the stream should be restarted with another latency.
+    """
+
+    def __init__(
+        self,
+        min_latency: float = 0.005,
+        max_latency: float = 0.5,
+        factor: float = 2.0,
+        interval: float = 5.0,
+        max_xruns: int = 2,
+        stable_checks: int = 6,
+        headroom: float = 0.5,
+    ):
+        """
+        Initialize the controller.
+
+        :param min_latency: lowest latency in seconds
+        :param max_latency: highest latency in seconds
+        :param factor: the latency is multiplied or divided by this factor
+        :param interval: time between two checks in seconds
+        :param max_xruns: number of xruns within a check that raise the latency
+        :param stable_checks: number of checks without xruns before the
+                              latency is lowered
+        :param headroom: the latency is only lowered if the 99th percentile of
+                         the callback duration is below this fraction of a block
+        """
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.factor = factor
+        self.interval = interval
+        self.max_xruns = max_xruns
+        self.stable_checks = stable_checks
+        self.headroom = headroom
+        # number of xruns at the last check
+        self.xruns: Optional[int] = None
+        # consecutive checks without xruns and with enough headroom
+        self.stable = 0
+        # the latency is never lowered to this latency or below
+        self.floor = 0.0
+
+    def check(
+        self, latency: float, xruns: int, duration: float, block: float
+    ) -> Optional[float]:
+        """
+        Check the telemetry of the last interval.
+
+        :param latency: current latency in seconds
+        :param xruns: total number of xruns
+        :param duration: 99th percentile of the callback duration in seconds
+        :param block: duration of a block in seconds
+        :return: the new latency or None to keep the current latency
+        """
+        new_xruns = 0 if self.xruns is None else xruns - self.xruns
+        self.xruns = xruns
+
+        if new_xruns >= self.max_xruns:
+            self.stable = 0
+            self.floor = max(self.floor, latency)
+            if latency < self.max_latency:
+                return min(latency * self.factor, self.max_latency)
+            return None
+
+        if new_xruns > 0 or duration > self.headroom * block:
+            self.stable = 0
+            return None
+
+        self.stable += 1
+        if self.stable < self.stable_checks:
+            return None
+        lower = latency / self.factor
+        if lower < self.min_latency or lower <= self.floor:
+            return None
+        self.stable = 0
+        return lower
+
+    def applied(self, previous: float, latency: float):
+        """
+        Report the latency of the stream after it has been restarted to lower
+        the latency.
+
+        :param previous: latency before the restart
+        :param latency: latency after the restart
+        """
+        if latency >= previous:
+            # the device does not support lower latencies
+            self.floor = max(self.floor, latency)
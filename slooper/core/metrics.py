@@ -0,0 +1,195 @@
+"""
+Metrics in the Prometheus text format.
+
+The audio callback only increments counters. Everything else (formatting,
+aggregation over recordings) happens when the metrics are requested.
+"""
+
+from threading import Lock
+from timeit import default_timer as timer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from slooper.core.valuestats import LogHistogram
+
+STATUS_FLAGS = [
+    "input_underflow",
+    "input_overflow",
+    "output_underflow",
+    "output_overflow",
+    "priming_output",
+]
+
+# functions that return formatted metrics, called for each request
+collectors: List[Callable[[], str]] = []
+# locks with wait and hold times
+locks: Dict[str, "TimedLock"] = {}
+
+
+class StatusCounter:
+    """
+    Counts the flags of the status that is passed to the stream callback.
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {name: 0 for name in STATUS_FLAGS}
+
+    def count(self, status):
+        """
+        Count all flags that are set.
+
+        :param status: callback flags, e.g. sounddevice.CallbackFlags
+        """
+        for name in STATUS_FLAGS:
+            if getattr(status, name, False):
+                self.counts[name] += 1
+
+
+class TimedLock:
+    """
+    Lock that measures how long threads wait for it and hold it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.acquired = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.hold_sum = 0.0
+        self.hold_max = 0.0
+        self._hold_start = 0.0
+
+    def acquire(self):
+        start = timer()
+        self._lock.acquire()
+        # only modified while holding the lock
+        self._hold_start = timer()
+        wait = self._hold_start - start
+        self.acquired += 1
+        self.wait_sum += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def release(self):
+        hold = timer() - self._hold_start
+        self.hold_sum += hold
+        self.hold_max = max(self.hold_max, hold)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, object]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def format_metric(
+    name: str,
+    kind: str,
+    help: str,
+    samples: Iterable[Tuple[Dict[str, object], float]],
+) -> str:
+    """
+    Format a metric.
+
+    :param name: metric name
+    :param kind: counter, gauge or histogram
+    :param help: description of the metric
+    :param samples: labels and value of each sample
+    :return: the metric in text format
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def format_histogram(
+    name: str, help: str, histogram: LogHistogram, total: float, step: int = 4
+) -> str:
+    """
+    Format a histogram.
+
+    :param name: metric name
+    :param help: description of the metric
+    :param histogram: the histogram
+    :param total: sum of all values
+    :param step: only every step-th bucket edge is included
+    :return: the histogram in text format
+    """
+    counts = list(histogram.counts)
+    samples = []
+    cumulative = 0
+    for i, count in enumerate(counts[:-1]):
+        cumulative += count
+        if i % step == 0:
+            samples.append(({"le": histogram.edges[i].item()}, cumulative))
+    cumulative += counts[-1]
+    samples.append(({"le": "+Inf"}, cumulative))
+
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    lines += [f"{name}_bucket{format_labels(labels)} {v}" for labels, v in samples]
+    lines.append(f"{name}_sum {total}")
+    lines.append(f"{name}_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def format_locks() -> str:
+    """
+    Format the wait and hold times of all registered locks.
+
+    :return: the metrics in text format
+    """
+    metrics = [
+        ("acquired_total", "counter", "Number of times the lock has been acquired"),
+        ("wait_seconds_total", "counter", "Total time spent waiting for the lock"),
+        ("wait_seconds_max", "gauge", "Maximum time spent waiting for the lock"),
+        ("hold_seconds_total", "counter", "Total time the lock has been held"),
+        ("hold_seconds_max", "gauge", "Maximum time the lock has been held"),
+    ]
+    values = {
+        name: (
+            lock.acquired,
+            lock.wait_sum,
+            lock.wait_max,
+            lock.hold_sum,
+            lock.hold_max,
+        )
+        for name, lock in locks.items()
+    }
+    return "".join(
+        format_metric(
+            f"slooper_lock_{suffix}",
+            kind,
+            help,
+            [({"lock": name}, v[i]) for name, v in values.items()],
+        )
+        for i, (suffix, kind, help) in enumerate(metrics)
+    )
+
+
+def collect() -> str:
+    """
+    Collect the metrics of all collectors.
+
+    :return: the metrics in text format
+    """
+    return "".join(collector() for collector in collectors)
+
+
+def render() -> str:
+    """
+    Collect all metrics.
+
+    :return: the metrics in text format
+    """
+    return format_locks() + collect()
@@ -0,0 +1,84 @@
+from typing import Iterable, Optional
+
+import numpy as np
+from slooper.core import fade
+from slooper.core.recording import PLAYING, Recording
+
+
+class Mixer:
+    """
+    Mixes the playback of all looping recordings with a single matrix-vector product.
+
+    The blocks of all tracks are gathered in a preallocated (tracks x samples)
+    matrix that is multiplied with the volume vector directly into the output.
+    Blocks of compact storages are converted to float32 while they are gathered,
+    their scale is part of the volume. Crossfades at loop seams and gain ramps
+    are applied to the gathered blocks.
+    """
+
+    def __init__(self, tracks: int = 16, frames: int = 1024, channels: int = 1):
+        """
+        Initialize the mixer. The buffers grow if a block does not fit.
+
+        :param tracks: initial number of tracks
+        :param frames: initial number of frames per block
+        :param channels: initial number of channels
+        """
+        # flat buffer, so that the matrix is contiguous for any block size
+        self.buffer = np.zeros(tracks * frames * channels, dtype=np.float32)
+        self.volumes = np.zeros(tracks, dtype=np.float32)
+        self.gains: Optional[np.ndarray] = None
+
+    def _reserve(self, tracks: int, samples: int):
+        if tracks <= self.volumes.shape[0] and tracks * samples <= self.buffer.shape[0]:
+            return
+
+        buffer, volumes = self.buffer, self.volumes
+        tracks = max(tracks, volumes.shape[0])
+        self.buffer = np.zeros(max(tracks * samples, buffer.shape[0]), dtype=np.float32)
+        self.volumes = np.zeros(tracks, dtype=np.float32)
+        # keep tracks that have already been gathered
+        self.buffer[: buffer.shape[0]] = buffer
+        self.volumes[: volumes.shape[0]] = volumes
+
+    def mix(self, recordings: Iterable[Recording], data_out: np.ndarray):
+        """
+        Overwrite data_out with the sum of all looping recordings.
+
+        :param recordings: all recordings, only played recordings are mixed
+        :param data_out: C-contiguous float32 output array of shape (frames, channels)
+        """
+        frames = data_out.shape[0]
+        samples = data_out.size
+        self._reserve(1, samples)
+
+        k = 0
+        for r in recordings:
+            if r.state not in PLAYING:
+                continue
+
+            start = r.frame
+            out = r.take(frames)
+            if out is None:
+                continue
+
+            if (k + 1) * samples > self.buffer.shape[0] or k == self.volumes.shape[0]:
+                # rare case: more tracks than expected
+                self._reserve(2 * (k + 1), samples)
+
+            block = self.buffer[k * samples : (k + 1) * samples].reshape(data_out.shape)
+            np.copyto(block, out)
+            r.apply_seam(start, block)
+            gain_start, gain_end = r.next_gain(frames)
+            if gain_start != gain_end:
+                self.gains = fade.apply_ramp(block, gain_start, gain_end, self.gains)
+                gain_end = 1.0
+            self.volumes[k] = gain_end * r.data.scale
+            k += 1
+
+        if k == 0:
+            data_out.fill(0)
+            return
+
+        blocks = self.buffer[: k * samples].reshape(k, samples)
+        np.dot(self.volumes[:k], blocks, out=data_out.reshape(-1))
@@ -1,47 +1,533 @@
 from enum import Enum
-import io
+import logging
+from threading import Lock
 import time
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
-import soundfile as sf
-from slooper.core.vector import RingAccessVector, RingSegmentList
+from slooper.core import export, fade
+from slooper.core.ring import FrameRing
+from slooper.core.vector import (
+    RingAccessVector,
+    RingBlockArena,
+    copy_elements,
+    to_float32,
+)
+from slooper.core.waveform import PeakPyramid, build_pyramid
 
 
 class State(Enum):
     Pause = "pause"
     Record = "record"
     Loop = "loop"
+    # loop and add the input to the data at the playback position
+    Overdub = "overdub"
+
+
+# states in which recordings are played back and in which their data is written
+PLAYING = (State.Loop, State.Overdub)
+WRITING = (State.Record, State.Overdub)
 
 
 class Recording:
-    def __init__(self):
-        self._data: RingAccessVector = RingSegmentList()
+    def __init__(self, data: Optional[RingAccessVector] = None):
+        self._data: RingAccessVector = RingBlockArena() if data is None else data
         self.state: State = State.Pause
         self.frame: int = 0
+        # target volume and the current gain that follows it within RAMP_FRAMES
         self.volume: float = 1.0
+        self.gain: float = 1.0
+        self.gain_step: float = 0.0
         self.name: str = ""
         self.timestamp = time.time()
+        # monotonic time of the last state change, recordings that have not been
+        # used for the longest time are compressed first
+        self.last_used = time.monotonic()
+        # waveform overview, updated while recording
+        self.peaks = PeakPyramid()
+
+        # input ring that is recorded from (if any), frames up to ring_written
+        # have been moved to the storage, ring_end is set when recording stops
+        self.ring: Optional[FrameRing] = None
+        self.ring_written = 0
+        self.ring_end: Optional[int] = None
+        # the input that was captured while a frame was played arrives this many
+        # frames later in the ring (round-trip latency)
+        self.ring_offset = 0
+        # index of the data that the next frame of the ring is added to while
+        # overdubbing, None while recording
+        self.overdub_frame: Optional[int] = None
+        # start, end and overdub frame of a recording from the ring that begins
+        # after the frames of the last recording have been moved
+        self.queued_start: Optional[int] = None
+        self.queued_end: Optional[int] = None
+        self.queued_overdub_frame: Optional[int] = None
+        # incremented whenever the data is changed in place
+        self.revision = 0
+        # held while frames are moved from the ring, never waited for by the callback
+        self.write_lock = Lock()
+        self.clear_requested = False
+
+        # frames that preceded the first recorded frame, read from the ring
+        self.preroll: Optional[np.ndarray] = None
+        self.preroll_end: Optional[int] = None
+        # length of the data and the frames (start, elements) that replace the
+        # data during playback to crossfade the seam of the loop
+        self.seam: Tuple[int, List[Tuple[int, np.ndarray]]] = (0, [])
+        # playback buffer of the recording if there is no mixer
+        self.block: Optional[np.ndarray] = None
+        self.gains: Optional[np.ndarray] = None
+
+    @property
+    def data(self) -> RingAccessVector:
+        return self._data
+
+    def set_data(self, data: RingAccessVector, copied: int):
+        """
+        Replace the storage of this recording.
+
+        :param data: the new storage that already holds a copy of the first
+                     elements of the current storage
+        :param copied: number of elements that have already been copied
+        :raises ValueError: if frames are being moved from the ring
+        """
+        if not self.write_lock.acquire(blocking=False):
+            raise ValueError("The recording is being written")
+        try:
+            # add elements that have been recorded in the meantime
+            copy_elements(self._data, data, copied)
+            if len(data) > 0:
+                data.set_idx(self.frame)
+            old_data = self._data
+            self._data = data
+            old_data.clear()
+        finally:
+            self.write_lock.release()
 
     def set_frame(self, new_frame):
         if self._data.set_idx(new_frame):
             self.frame = new_frame
 
+    def trim(self, start: int, end: int):
+        """
+        Restrict playback, downloads and waveforms to the frames [start, end)
+        without copying them. The data is copied later to release the memory.
+
+        :param start: first frame that is kept
+        :param end: frame after the last frame that is kept
+        :raises ValueError: if the window is invalid or the storage cannot be trimmed
+        """
+        self._data.trim(start, end)
+        frame = self.frame - start
+        self.frame = 0
+        if 0 <= frame < end - start:
+            self.set_frame(frame)
+        # the frames before the first frame are not known anymore
+        self.preroll = None
+        self.render_seam()
+
     def record(self, data_in: np.ndarray):
         self._data.append(data_in)
+        self.peaks.append(data_in)
 
-    def loop(self, data_out: np.ndarray):
-        n = data_out.shape[0]
+    def start_recording(
+        self, ring: FrameRing, offset: int = 0, overdub_frame: Optional[int] = None
+    ):
+        """
+        Record the frames that are written to the ring from now on. They are
+        moved to the storage by write_pending. If the frames of the last
+        recording are still being moved, the recording starts after them.
+
+        :param ring: the input ring
+        :param offset: round-trip latency in frames, the recording starts and
+                       stops this many frames later in the ring
+        :param overdub_frame: index of the data that the frames are added to,
+                              None to append them
+        :raises ValueError: if another recording is already waiting for the
+                            frames of the last recording
+        """
+        start = ring.write_pos + offset
+        if self.ring is not None and (
+            self.ring_end is None or self.queued_start is not None
+        ):
+            raise ValueError("The recording is being written")
+        self.ring_offset = offset
+        if self.ring is not None:
+            self.queued_start = start
+            self.queued_end = None
+            self.queued_overdub_frame = overdub_frame
+            return
+        self._start_ring(ring, start, overdub_frame)
+
+    def _start_ring(self, ring: FrameRing, start: int, overdub_frame: Optional[int]):
+        if overdub_frame is not None:
+            # fails before anything has been changed
+            self._data.begin_layer()
+        self.overdub_frame = overdub_frame
+        self.ring_end = None
+        self.ring_written = start
+        if len(self._data) == 0:
+            self.preroll = None
+            self.preroll_end = start
+        self.ring = ring
+
+    def _start_queued(self, ring: FrameRing):
+        start, end = self.queued_start, self.queued_end
+        overdub_frame = self.queued_overdub_frame
+        self.queued_start = None
+        self.queued_end = None
+        self.queued_overdub_frame = None
+        try:
+            self._start_ring(ring, start, overdub_frame)
+        except ValueError as e:
+            logging.warning(f"Could not start recording: {e}")
+            return
+        self.ring_end = end
+
+    def start_overdub(self, ring: Optional[FrameRing], offset: int = 0):
+        """
+        Add the input to the data from the current frame on. Changes form a
+        layer that can be undone.
+
+        :param ring: the input ring or None if the input is added by overdub
+        :param offset: round-trip latency in frames (only used with a ring)
+        :raises ValueError: if the recording is empty or cannot be changed in place
+        """
+        if len(self._data) == 0:
+            raise ValueError("Cannot overdub an empty recording")
+        if not self._data.mixable:
+            raise ValueError(
+                f"{type(self._data).__name__} does not support overdubbing"
+            )
+        if ring is None:
+            self._data.begin_layer()
+        else:
+            self.start_recording(ring, offset, overdub_frame=self.frame)
+
+    def overdub(self, data_in: np.ndarray):
+        """
+        Add the input to the block that has just been played.
+
+        :param data_in: input of shape (frames, channels)
+        """
+        self._data.mix(data_in, self.frame - data_in.shape[0])
+
+    def stop_recording(self, delayed: bool = True):
+        """
+        Stop recording or overdubbing from the ring at its current position. The
+        remaining frames are moved to the storage immediately unless they are
+        being written by another thread or arrive within the offset, then the
+        writer thread completes the recording.
+
+        :param delayed: whether to wait for the frames within the offset, e.g.
+                        not if the stream has been stopped
+        """
+        if self.ring is None:
+            self._finish_layer()
+            return
+        end = self.ring.write_pos + (self.ring_offset if delayed else 0)
+        if self.queued_start is not None:
+            # stops the recording that waits for the last recording
+            if end > self.queued_start:
+                self.queued_end = end
+            else:
+                # e.g. the stream has been stopped before it would have started
+                self.queued_start = None
+                self.ring_end = min(self.ring_end, end)
+            self.finish_recording()
+            return
+        self.ring_end = end
+        self.finish_recording()
+
+    def finish_recording(self) -> bool:
+        """
+        Move the available frames from the ring without waiting for the writer.
+
+        :return: whether the frames could be moved
+        """
+        if not self.write_lock.acquire(blocking=False):
+            return False
+        try:
+            self._write_ring()
+        finally:
+            self.write_lock.release()
+        return True
+
+    def write_pending(self):
+        """
+        Move the frames that have been recorded to the ring to the storage.
+        Called by the writer thread.
+        """
+        with self.write_lock:
+            self._write_ring()
+
+    def _write_ring(self):
+        ring = self.ring
+        if ring is not None:
+            if self.preroll_end is not None:
+                self._read_preroll(ring)
+            # read the position first, recording may stop in the meantime
+            pos = ring.write_pos
+            end = self.ring_end
+            self._append_ring(ring, pos if end is None else min(pos, end))
+            end = self.ring_end
+            if end is not None and end <= pos:
+                self._append_ring(ring, end)
+                self.ring = None
+                self.ring_end = None
+                self._finish_layer()
+                if self.queued_start is not None:
+                    self._start_queued(ring)
+                    # the frames of the next recording may be available already
+                    self._write_ring()
+
+        # requested while the frames were moved
+        if self.clear_requested:
+            self.clear_requested = False
+            self.ring = None
+            self.ring_end = None
+            self.overdub_frame = None
+            self.queued_start = None
+            self._data.clear()
+            self.peaks.clear()
+            self.seam = (0, [])
+            self.frame = 0
+
+    def _read_preroll(self, ring: FrameRing):
+        end = self.preroll_end
+        if end > ring.write_pos:
+            # the frames arrive with the offset
+            return
+        self.preroll_end = None
+        start = end - fade.SEAM_FRAMES
+        # the frames must not be overwritten while they are read
+        if start >= 0 and ring.write_pos - start <= ring.capacity // 2:
+            self.preroll = np.concatenate(ring.segments(start, end))
+
+    def _append_ring(self, ring: FrameRing, end: int):
+        for segment in ring.segments(self.ring_written, end):
+            if self.overdub_frame is None:
+                self.record(segment)
+            else:
+                self._data.mix(segment, self.overdub_frame)
+                self.overdub_frame = (self.overdub_frame + len(segment)) % len(
+                    self._data
+                )
+        self.ring_written = max(self.ring_written, end)
+
+    def _finish_layer(self):
+        # without a ring, the layer is finished before the state changes
+        ringless = self.state == State.Overdub and self.queued_start is None
+        if self.overdub_frame is not None or ringless:
+            self.overdub_frame = None
+            self._data.end_layer()
+            self._changed()
+        self.render_seam()
+
+    def _changed(self):
+        # the waveform is computed again from the data
+        self.revision += 1
+        self.peaks.clear()
+
+    def undo(self):
+        """
+        Revert the last overdub.
+
+        :raises ValueError: if there is nothing to undo
+        """
+        if not self._data.undo():
+            raise ValueError("There is nothing to undo")
+        self._changed()
+        self.render_seam()
+
+    def redo(self):
+        """
+        Apply the last reverted overdub again.
+
+        :raises ValueError: if there is nothing to redo
+        """
+        if not self._data.redo():
+            raise ValueError("There is nothing to redo")
+        self._changed()
+        self.render_seam()
+
+    def take(self, n: int) -> Optional[np.ndarray]:
+        if self.ring_end is not None and not self.finish_recording():
+            # the last recorded frames are still being moved from the ring
+            return None
         out = self._data.take(n)
         if out is not None:
-            data_out += out * self.volume
             self.frame = (self.frame + n) % len(self._data)
+        return out
+
+    def loop(self, data_out: np.ndarray):
+        frames = data_out.shape[0]
+        start = self.frame
+        out = self.take(frames)
+        if out is None:
+            return
+
+        if self.block is None or self.block.shape != data_out.shape:
+            self.block = np.empty(data_out.shape, dtype=np.float32)
+        np.copyto(self.block, out)
+        self.apply_seam(start, self.block)
+        gain_start, gain_end = self.next_gain(frames)
+        if gain_start != gain_end:
+            self.gains = fade.apply_ramp(self.block, gain_start, gain_end, self.gains)
+            gain_end = 1.0
+        # elements of compact storages are converted with the gain
+        self.block *= np.float32(gain_end * self._data.scale)
+        data_out += self.block
+
+    def set_volume(self, volume: float):
+        """
+        Change the volume, the gain follows it within RAMP_FRAMES frames.
+
+        :param volume: the new volume
+        """
+        self.gain_step = abs(volume - self.gain) / fade.RAMP_FRAMES
+        self.volume = volume
+
+    def next_gain(self, frames: int) -> Tuple[float, float]:
+        """
+        Advance the gain by a block.
+
+        :param frames: the block size
+        :return: the gain before the first and at the last frame of the block
+        """
+        start = self.gain
+        if start != self.volume:
+            delta = self.gain_step * frames
+            if delta == 0 or abs(self.volume - start) <= delta:
+                # e.g. volumes of restored recordings are applied directly
+                self.gain = self.volume
+            elif self.volume > start:
+                self.gain = start + delta
+            else:
+                self.gain = start - delta
+        return start, self.gain
+
+    def read(self, start: int, n: int) -> np.ndarray:
+        """
+        Copy elements of the data.
+
+        :param start: index of the first element
+        :param n: number of elements
+        :return: float32 array with the elements (not converted with the scale)
+        """
+        return self._data.read(start, n).astype(np.float32)
+
+    def render_seam(self):
+        """
+        Render the crossfade at the seam of the loop. The last frames fade into
+        the frames that preceded the first frame. If they are unknown, the last
+        frames fade out and the first frames fade in.
+        """
+        length = len(self._data)
+        n = fade.SEAM_FRAMES
+        if length < 2 * n:
+            self.seam = (0, [])
+            return
+
+        fade_out, fade_in = fade.crossfade(n)
+        tail = self.read(length - n, n) * fade_out
+        preroll = self.preroll
+        if preroll is not None and preroll.shape[1] == tail.shape[1]:
+            tail += to_float32(preroll) / np.float32(self._data.scale) * fade_in
+            self.seam = (length, [(length - n, tail)])
+        else:
+            head = self.read(0, n) * fade_in
+            self.seam = (length, [(length - n, tail), (0, head)])
+
+    def apply_seam(self, start: int, block: np.ndarray):
+        """
+        Replace the elements of a block that belong to the crossfade at the seam.
+
+        :param start: index of the first element of the block
+        :param block: float32 copy of the elements of the block
+        """
+        length, patches = self.seam
+        if length != len(self._data):
+            # the data has changed since the seam has been rendered
+            return
+
+        frames = block.shape[0]
+        for patch_start, patch in patches:
+            n = patch.shape[0]
+            # the block may start inside the patch
+            offset = (start - patch_start) % length
+            if offset < n:
+                m = min(n - offset, frames)
+                block[:m] = patch[offset : offset + m]
+            # and contain its beginning (multiple times for short loops)
+            pos = (patch_start - start) % length
+            if pos == 0:
+                pos = length
+            while pos < frames:
+                m = min(n, frames - pos)
+                block[pos : pos + m] = patch[:m]
+                pos += length
+
+    def clear(self):
+        # cleared by the writer if it is moving frames at the moment
+        self.clear_requested = True
+        self.finish_recording()
+
+    def close(self):
+        self._data.close()
+
+    def prefetch(self):
+        self._data.prefetch()
+
+    def waveform(self, width: int) -> Tuple[np.ndarray, float]:
+        """
+        Get the waveform overview of this recording.
+
+        :param width: maximum number of bins
+        :return: array of shape (bins, 3) with min, max and rms of each bin and
+                 the number of frames per bin
+        :raises ValueError: if the waveform has to be computed while the
+                            recording is being overdubbed
+        """
+        if self.peaks.frames != len(self._data) and self.state != State.Record:
+            # e.g. restored recordings, computed once from their data
+            self.check_readable()
+            with self._data.reading():
+                self.peaks = build_pyramid(
+                    self._data.segments(), scale=self._data.scale
+                )
+        return self.peaks.get(width)
+
+    def check_readable(self):
+        """
+        Check that the data is not changed in place while it is read.
+
+        :raises ValueError: if the recording is being overdubbed
+        """
+        if self.state == State.Overdub or self.overdub_frame is not None:
+            raise ValueError("Cannot read the recording while overdubbing")
+
+    def export(self, samplerate, format: str = "flac") -> Iterator[bytes]:
+        """
+        Encode the current content of this recording incrementally.
+
+        :param samplerate: the samplerate
+        :param format: "flac" or "wav"
+        :return: iterator over the bytes of the encoded file
+        :raises ValueError: if the recording is being overdubbed
+        """
+        self.check_readable()
+        return self._encode(self._data, int(samplerate), format)
 
-    def create_bytes_io(self, samplerate):
-        bytes_io = io.BytesIO()
-        sf.write(
-            bytes_io, self._data.numpy(), samplerate=int(samplerate), format="FLAC"
-        )
-        return bytes_io
+    @staticmethod
+    def _encode(data: RingAccessVector, samplerate: int, format: str):
+        # the segments are taken when the encoding starts and held until it ends
+        with data.reading():
+            segments = data.segments()
+            if format == "wav":
+                yield from export.stream_wav(segments, samplerate, scale=data.scale)
+            else:
+                yield from export.stream_flac(segments, samplerate, scale=data.scale)
 
     def get_info_dict(self):
         return {
@@ -50,4 +536,7 @@ class Recording:
             "volume": self.volume,
             "frame": self.frame,
             "length": len(self._data),
+            "bytes": self._data.nbytes,
+            "undo": self._data.history[0],
+            "redo": self._data.history[1],
         }
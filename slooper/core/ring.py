@@ -0,0 +1,89 @@
+"""
+Preallocated ring buffer that passes the input of the callback to a writer
+thread without locks or allocations.
+"""
+
+from typing import List
+
+import numpy as np
+
+
+class FrameRing:
+    """
+    Single producer, single consumer ring buffer of frames.
+
+    Positions are absolute frame counts since the creation of the ring. The
+    producer only modifies write_pos and the consumer only modifies read_pos,
+    so neither of them has to acquire a lock.
+    """
+
+    def __init__(self, capacity: int, channels: int = 1, dtype=np.float32):
+        """
+        Initialize the ring.
+
+        :param capacity: maximum number of frames that have not been consumed
+        :param channels: number of channels
+        :param dtype: data type of the frames
+        """
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        # number of frames that have been written
+        self.write_pos = 0
+        # frames before this position have been consumed and can be overwritten
+        self.read_pos = 0
+        # blocks (and their frames) that have been dropped as the ring was full
+        self.overflows = 0
+        self.overflow_frames = 0
+
+    def write(self, x: np.ndarray) -> bool:
+        """
+        Copy frames into the ring (producer).
+
+        :param x: array of shape (frames, channels)
+        :return: whether the frames have been written, they are dropped if the
+                 ring does not have enough free space
+        """
+        n = x.shape[0]
+        if self.write_pos + n - self.read_pos > self.capacity:
+            self.overflows += 1
+            self.overflow_frames += n
+            return False
+
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start : start + first] = x[:first]
+        if first < n:
+            self.data[: n - first] = x[first:]
+        # publish the frames after they have been copied
+        self.write_pos += n
+        return True
+
+    def segments(self, start: int, end: int) -> List[np.ndarray]:
+        """
+        Get the frames between two positions without copying them (consumer).
+
+        :param start: first position, must not be before read_pos
+        :param end: position after the last frame, must not be after write_pos
+        :return: up to two views of the frames
+        """
+        if end <= start:
+            return []
+        offset = start % self.capacity
+        first = min(end - start, self.capacity - offset)
+        segments = [self.data[offset : offset + first]]
+        if first < end - start:
+            segments.append(self.data[: end - start - first])
+        return segments
+
+    def release(self, pos: int):
+        """
+        Mark all frames before a position as consumed (consumer).
+
+        :param pos: the position
+        """
+        if pos > self.read_pos:
+            self.read_pos = pos
+
+    def __len__(self):
+        # number of frames that have not been consumed
+        return self.write_pos - self.read_pos
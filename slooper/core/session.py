@@ -0,0 +1,169 @@
+"""
+Persistence of all recordings in a session directory.
+
+Each recording is stored as raw float32 file next to a metadata file with its
+name, volume, frame and timestamp. Restored recordings read their file on
+demand, so restoring a session does not load any audio.
+"""
+
+import logging
+import os
+from typing import Dict, Set
+from weakref import WeakKeyDictionary
+
+import numpy as np
+import yaml
+
+from slooper.core.recording import Recording
+from slooper.core.vector import RingFileArray, to_float32
+
+METADATA_FILE = "session.yaml"
+
+# file, length, revision and channels of recordings in memory at the time they
+# have been saved
+saved_copies: "WeakKeyDictionary[Recording, tuple]" = WeakKeyDictionary()
+
+
+def write_raw(path: str, recording: Recording) -> int:
+    """
+    Write the data of a recording to a raw float32 file.
+
+    :param path: the file path
+    :param recording: the recording
+    :return: number of channels
+    """
+    channels = 1
+    tmp_path = path + ".tmp"
+    data = recording.data
+    with open(tmp_path, "wb") as f, data.reading():
+        for segment in data.segments():
+            f.write(np.ascontiguousarray(to_float32(segment, data.scale)))
+            channels = segment.shape[1]
+    os.replace(tmp_path, path)
+    return channels
+
+
+def save_session(directory: str, recordings: Dict[str, Recording], samplerate):
+    """
+    Save the recordings in a directory. Recordings on disk are not copied and
+    recordings in memory are only written if they have changed.
+
+    :param directory: the session directory
+    :param recordings: the recordings
+    :param samplerate: samplerate of the recordings
+    """
+    metadata_path = os.path.join(directory, METADATA_FILE)
+    old_files = {entry["file"] for entry in load_metadata(directory).values()}
+
+    entries = {}
+    for key, r in recordings.items():
+        length = len(r.data)
+        if length == 0:
+            continue
+
+        start = 0
+        if isinstance(r.data, RingFileArray):
+            file = os.path.basename(r.data.path)
+            channels = r.data.channels
+            # trimmed frames at the start of the file
+            start = r.data.trim_start
+        else:
+            file = f"recording-{key}.raw"
+            saved = saved_copies.get(r)
+            # overdubs change the data in place, only the revision changes
+            if saved is None or saved[:3] != (file, length, r.revision):
+                channels = write_raw(os.path.join(directory, file), r)
+                saved = (file, length, r.revision, channels)
+                saved_copies[r] = saved
+            channels = saved[3]
+
+        entries[str(key)] = {
+            "file": file,
+            "start": start,
+            "length": length,
+            "channels": channels,
+            "name": r.name,
+            "volume": r.volume,
+            "frame": r.frame,
+            "timestamp": r.timestamp,
+        }
+
+    tmp_path = metadata_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        yaml.dump({"samplerate": float(samplerate), "recordings": entries}, f)
+    os.replace(tmp_path, metadata_path)
+
+    # remove files of deleted recordings
+    for file in old_files - {entry["file"] for entry in entries.values()}:
+        path = os.path.join(directory, file)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_metadata(directory: str) -> Dict[str, dict]:
+    """
+    Load the metadata of all recordings in a directory.
+
+    :param directory: the session directory
+    :return: dict with the metadata of each recording
+    """
+    try:
+        with open(os.path.join(directory, METADATA_FILE), "r") as f:
+            metadata = yaml.load(f, Loader=yaml.SafeLoader)
+    except FileNotFoundError:
+        return {}
+    return metadata.get("recordings", {})
+
+
+def load_session(directory: str) -> Dict[str, Recording]:
+    """
+    Restore the recordings of a directory without reading their data.
+
+    Files in the directory that do not belong to a recording are removed.
+
+    :param directory: the session directory
+    :return: dict with the restored recordings
+    """
+    recordings = {}
+    for key, entry in load_metadata(directory).items():
+        path = os.path.join(directory, entry["file"])
+        if not os.path.exists(path):
+            logging.warning(f"Could not restore recording {key}, missing {path}")
+            continue
+
+        start = entry.get("start", 0)
+        data = RingFileArray(
+            directory,
+            path=path,
+            size=start + entry["length"],
+            channels=entry["channels"],
+        )
+        if start > 0:
+            data.trim(start, start + entry["length"])
+        r = Recording(data)
+        r.name = entry["name"]
+        r.volume = entry["volume"]
+        r.gain = r.volume
+        r.timestamp = entry["timestamp"]
+        r.set_frame(entry["frame"])
+        recordings[key] = r
+
+    remove_unused_files(
+        directory, {os.path.basename(r.data.path) for r in recordings.values()}
+    )
+
+    if len(recordings) > 0:
+        logging.info(f"Restored {len(recordings)} recordings from {directory}")
+    return recordings
+
+
+def remove_unused_files(directory: str, used_files: Set[str]):
+    """
+    Remove the recording files in a directory that are not used.
+
+    :param directory: the session directory
+    :param used_files: names of the files to keep
+    """
+    for file in os.listdir(directory):
+        if file.endswith(".raw") and file not in used_files:
+            os.remove(os.path.join(directory, file))
@@ -1,18 +1,35 @@
 import atexit
+import heapq
 import logging
 import os
 from pathlib import Path
 import shutil
-from threading import Lock
-import collections
+from threading import Event, Thread
 import traceback
-from typing import Optional, Tuple, Union
+import time
+from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
-import sounddevice as sd
 
 from viztracer import VizTracer, get_tracer
 import yaml
-from slooper.core.recording import Recording, State
+from slooper.core import backend, calibration, metrics
+from slooper.core.backend import AudioBackend
+from slooper.core.command import Command, CommandQueue, Op, Quantize
+from slooper.core.latency import XRUN_FLAGS, LatencyController
+from slooper.core.mixer import Mixer
+from slooper.core import session
+from slooper.core.recording import PLAYING, WRITING, Recording, State
+from slooper.core.ring import FrameRing
+from slooper.core.vector import (
+    ChunkPool,
+    RingAccessVector,
+    RingBlockArena,
+    RingCompressedArray,
+    RingFileArray,
+    RingGrowingArray,
+    copy_elements,
+    default_chunk_pool,
+)
 
 from slooper.core.valuestats import ValueStats
 from timeit import default_timer as timer
@@ -24,12 +41,94 @@ if __debug__:
     callback_thread_added = False
 
 # store stream and recordings as global variables
-stream = None
-recordings = collections.defaultdict(lambda: Recording())
-duration_stats = ValueStats(capacity=100, dtype=float)
+stream: Optional[AudioBackend] = None
+recordings: Dict[str, Recording] = {}
+duration_stats = ValueStats(capacity=1000)
 
-# lock for the recordings
-lock = Lock()
+# copy of the recordings dict for readers outside of the callback, it is
+# replaced (never modified) whenever recordings are added or removed
+recordings_snapshot: Dict[str, Recording] = {}
+
+# state changes that are applied by the callback
+commands = CommandQueue()
+
+# commands that are applied at a future frame, ordered by frame (min-heap)
+schedule: List[Command] = []
+# number of frames that have been processed since the stream has been started
+frame_counter = 0
+# quantization of transport commands from the web interface
+default_quantize = Quantize.Block
+# incremented whenever a command has been applied or the stream has been
+# started or closed, lets readers detect state changes without comparing states
+state_version = 0
+# sum of the revisions of all recordings when they have last been written
+written_revisions = 0
+
+# mixes all looping recordings at once, None to add them one by one
+mixer: Optional[Mixer] = None
+
+# data types of the storage of new recordings
+PRECISIONS = {"float32": np.float32, "float16": np.float16, "int16": np.int16}
+precision = "float32"
+# chunks of new recordings
+storage_pool: ChunkPool = default_chunk_pool
+# data structure of new recordings: chunks from storage_pool (arena) or a single
+# array (growing)
+STORAGES = ["arena", "growing"]
+storage = "arena"
+
+# lock for starting and closing the stream, never acquired by the callback
+lock = metrics.TimedLock()
+metrics.locks["stream"] = lock
+
+# counters for metrics, only incremented
+status_counter = metrics.StatusCounter()
+commands_executed = 0
+command_wait_sum = 0.0
+
+# real-time priority that the callback thread sets on its next call, None to
+# keep the priority of the thread
+callback_priority: Optional[int] = None
+# priority that the callback thread has set, set again after a restart
+applied_priority: Optional[int] = None
+# number of frames of the last block
+block_frames = 0
+
+# input of the callback for the writer thread, None to record in the callback
+input_ring: Optional[FrameRing] = None
+writer_thread: Optional[Thread] = None
+writer_stop = Event()
+# round-trip latency of the device (in frames), recordings from the input ring
+# start and stop this many frames later
+record_offset = 0
+# latency measurement that replaces the output while it is running
+active_calibration: Optional[calibration.Calibration] = None
+
+# arguments of the last stream_start, the stream is restarted with them
+start_options: dict = {}
+# restarts the stream with another latency, None to keep the latency
+latency_controller: Optional[LatencyController] = None
+controller_thread: Optional[Thread] = None
+# set to stop the controller thread, a new event is created for each thread
+controller_stop = Event()
+# number of restarts and whether the stream is being restarted
+restarts = 0
+restarting = False
+
+# background work that should not run in the callback
+housekeeping_thread: Optional[Thread] = None
+housekeeping_stop = Event()
+
+# directory for recordings on disk
+session_dir: Optional[str] = None
+# recordings longer than this (in seconds) are moved to disk, None to disable
+spill_threshold: Optional[float] = None
+# interval (in seconds) to save the session, None to disable persistence
+autosave_interval: Optional[float] = None
+# maximum memory of all recordings (in bytes), paused recordings are compressed
+# or moved to disk if it is exceeded. None for no limit.
+memory_budget: Optional[int] = None
+memory_warning_logged = False
 
 
 def callback(
@@ -37,7 +136,7 @@ def callback(
     data_out: np.ndarray,
     frames: int,
     time,
-    status: sd.CallbackFlags,
+    status,
 ):
     if __debug__:
         global callback_thread_added
@@ -45,95 +144,942 @@ def callback(
             get_tracer().enable_thread_tracing()
             callback_thread_added = True
 
-    global recordings, lock
+    global frame_counter, callback_priority, applied_priority, block_frames
+
+    if callback_priority is not None:
+        backend.set_realtime_priority(callback_priority)
+        applied_priority = callback_priority
+        callback_priority = None
+    block_frames = frames
 
     if status:
+        status_counter.count(status)
         logging.warning(status)
 
     start = timer()
 
-    # add recordings
-    data_out.fill(0)
-    with lock:
-        for r in recordings.values():
-            if r.state == State.Record:
-                r.record(data_in)
-            elif r.state == State.Loop:
-                r.loop(data_out)
+    # apply pending state changes
+    drain_commands(scheduling=True)
+
+    if len(schedule) == 0:
+        process(data_in, data_out)
+    else:
+        # split the block at the frames of scheduled commands
+        pos = 0
+        while pos < frames:
+            end = frames
+            if len(schedule) > 0:
+                end = min(end, max(pos, schedule[0].frame - frame_counter))
+            if end > pos:
+                process(data_in[pos:end], data_out[pos:end])
+                pos = end
+            while len(schedule) > 0 and schedule[0].frame <= frame_counter + pos:
+                apply_scheduled(heapq.heappop(schedule))
+
+    if active_calibration is not None:
+        active_calibration.process(data_in, data_out)
+
+    frame_counter += frames
 
     duration = timer() - start
     duration_stats.insert(duration)
 
 
-def get_devices_list():
-    return str(sd.query_devices()).split("\n")
+def process(data_in: np.ndarray, data_out: np.ndarray):
+    """
+    Record and play back all recordings for a (part of a) block.
 
+    :param data_in: input of shape (frames, channels)
+    :param data_out: output of shape (frames, channels)
+    """
+    if input_ring is not None:
+        # recordings are written by the writer thread
+        input_ring.write(data_in)
+    if mixer is None:
+        data_out.fill(0)
+    for r in recordings.values():
+        if r.state == State.Record:
+            if input_ring is None:
+                r.record(data_in)
+        elif r.state in PLAYING and mixer is None:
+            r.loop(data_out)
+
+    if mixer is not None:
+        mixer.mix(recordings.values(), data_out)
+
+    if input_ring is None:
+        # the input is added after the block has been played
+        for r in recordings.values():
+            if r.state == State.Overdub:
+                r.overdub(data_in)
+
+
+def get_master() -> Optional[Recording]:
+    """
+    Get the master loop, i.e. the first recording that is looping.
 
-def restart_sounddevice():
-    sd._terminate()
-    sd._initialize()
+    :return: the master loop or None if no recording is looping
+    """
+    for r in recordings.values():
+        if r.state in PLAYING and len(r.data) > 0:
+            return r
+    return None
 
 
-def search_device(name: Union[int, str], kind: Optional[str] = None):
-    logging.info(f"Trying to find device containing '{name}' (kind {kind})")
+def get_schedule_frame(command: Command) -> int:
+    """
+    Get the stream frame at which a command should be applied.
+
+    :param command: the command
+    :return: the frame
+    """
+    if command.frame is not None:
+        return command.frame
+    if command.quantize == Quantize.Loop:
+        master = get_master()
+        if master is not None:
+            length = len(master.data)
+            return frame_counter + (length - master.frame) % length
+    return frame_counter
+
+
+def apply_scheduled(command: Command):
     try:
-        search_result = sd.query_devices(name, kind)
-        return search_result["name"]
-    except Exception:
-        raise ValueError(
-            f"Could not find device with name containing '{name}'.\n"
-            f"Available devices:\n {sd.query_devices()}"
+        apply_command(command)
+    except Exception as e:
+        # the handler does not wait for scheduled commands
+        command.error = e
+        logging.warning(f"Could not apply scheduled {command}: {e}")
+
+
+def apply_command(command: Command):
+    """
+    Apply a command to the recordings. Must only be called by the callback or
+    while the stream is not running.
+
+    :param command: the command
+    """
+    global recordings, recordings_snapshot, state_version
+
+    state_version += 1
+    op = command.op
+    if op == Op.PauseAll:
+        for r in recordings.values():
+            set_state(r, State.Pause)
+        return
+    elif op == Op.Clear:
+        old_recordings = recordings
+        recordings = {}
+        recordings_snapshot = {}
+        for r in old_recordings.values():
+            if autosave_interval is None:
+                # no session keeps the spilled recordings
+                r.clear()
+            else:
+                r.close()
+        return
+    elif op == Op.Restore:
+        recordings.update(command.value)
+        recordings_snapshot = dict(recordings)
+        return
+    elif op == Op.Batch:
+        validate_batch(command.value)
+        for c in command.value:
+            apply_command(c)
+        return
+
+    r = recordings.get(command.key)
+    if r is None:
+        if op != Op.Record or command.value is None:
+            raise KeyError(f"Recording with key '{command.key}' does not exist")
+        # the recording has been created by the producer to avoid allocations here
+        r = command.value
+        recordings[command.key] = r
+        recordings_snapshot = dict(recordings)
+
+    if op == Op.Record:
+        set_state(r, State.Record)
+    elif op == Op.Loop:
+        set_state(r, State.Loop)
+    elif op == Op.Overdub:
+        set_state(r, State.Overdub)
+    elif op == Op.Pause:
+        set_state(r, State.Pause)
+    elif op == Op.SetFrame:
+        if r.state in WRITING:
+            raise ValueError("Cannot set frame while recording")
+        r.set_frame(command.value)
+    elif op == Op.SetName:
+        r.name = command.value
+    elif op == Op.SetVolume:
+        r.set_volume(command.value)
+    elif op == Op.Trim:
+        if r.state in WRITING:
+            raise ValueError("Cannot trim while recording")
+        r.trim(*command.value)
+    elif op in [Op.Undo, Op.Redo]:
+        if r.state in WRITING:
+            raise ValueError(f"Cannot {op.value} while recording")
+        if op == Op.Undo:
+            r.undo()
+        else:
+            r.redo()
+    elif op == Op.SetData:
+        r.set_data(*command.value)
+    elif op == Op.Delete:
+        del recordings[command.key]
+        recordings_snapshot = dict(recordings)
+        r.clear()
+
+
+def set_state(r: Recording, state: State):
+    """
+    Change the state of a recording, starts and stops recording from the
+    input ring.
+
+    :param r: the recording
+    :param state: the new state
+    """
+    if r.state == state:
+        r.last_used = time.monotonic()
+        return
+    if state == State.Overdub:
+        if r.state == State.Record:
+            r.stop_recording()
+            # keeps looping if overdubbing is not possible
+            r.state = State.Loop
+        r.start_overdub(input_ring, record_offset)
+    elif r.state in WRITING:
+        r.stop_recording()
+    if state == State.Record and input_ring is not None:
+        r.start_recording(input_ring, record_offset)
+    r.state = state
+    r.last_used = time.monotonic()
+
+
+def validate_batch(batch: List[Command]):
+    """
+    Check that all commands of a batch can be applied, so that either all or
+    none of them are applied.
+
+    :param batch: the commands
+    :raises KeyError: if a command refers to a recording that does not exist
+    :raises ValueError: if a command cannot be applied in the current state
+    """
+    # states of the recordings after each command
+    states = {key: r.state for key, r in recordings.items()}
+    for c in batch:
+        if c.op in [
+            Op.Clear,
+            Op.Restore,
+            Op.Batch,
+            Op.SetData,
+            Op.Trim,
+            Op.Undo,
+            Op.Redo,
+        ]:
+            raise ValueError(f"Operation {c.op.value} is not supported in batches")
+        elif c.op == Op.PauseAll:
+            states = dict.fromkeys(states, State.Pause)
+            continue
+
+        if c.key not in states and (c.op != Op.Record or c.value is None):
+            raise KeyError(f"Recording with key '{c.key}' does not exist")
+        if c.op == Op.Record:
+            states[c.key] = State.Record
+        elif c.op == Op.Loop:
+            states[c.key] = State.Loop
+        elif c.op == Op.Overdub:
+            r = recordings.get(c.key)
+            if r is None or len(r.data) == 0 or not isinstance(r.data, RingBlockArena):
+                raise ValueError(f"Cannot overdub {c.key} in a batch")
+            states[c.key] = State.Overdub
+        elif c.op == Op.Pause:
+            states[c.key] = State.Pause
+        elif c.op == Op.SetFrame and states[c.key] in WRITING:
+            raise ValueError("Cannot set frame while recording")
+        elif c.op == Op.Delete:
+            del states[c.key]
+
+
+def drain_commands(scheduling: bool = False):
+    """
+    Apply all pending commands without blocking.
+
+    :param scheduling: whether commands for future frames are scheduled,
+                       otherwise they are applied immediately
+    """
+    command = commands.get()
+    while command is not None:
+        if not command.claim():
+            # cancelled by the producer
+            command = commands.get()
+            continue
+        frame = get_schedule_frame(command) if scheduling else frame_counter
+        if frame > frame_counter:
+            # applied by the callback, the producer does not wait for it
+            command.frame = frame
+            heapq.heappush(schedule, command)
+        else:
+            try:
+                apply_command(command)
+            except Exception as e:
+                command.error = e
+        command.done.set()
+        command = commands.get()
+
+
+def pending_scheduled() -> int:
+    """
+    Get the number of commands that are scheduled for future frames.
+    """
+    return len(schedule)
+
+
+def flush_schedule():
+    """
+    Apply all scheduled commands immediately.
+    """
+    while len(schedule) > 0:
+        apply_scheduled(heapq.heappop(schedule))
+
+
+def execute(command: Command, timeout: float = 1.0):
+    """
+    Execute a command and wait until it has been applied.
+
+    If the stream is running, the command is applied by the callback. Otherwise,
+    it is applied directly.
+
+    :param command: the command
+    :param timeout: maximum time in seconds to wait for the callback
+    :raises KeyError: if the command refers to a recording that does not exist
+    :raises ValueError: if the command cannot be applied in the current state
+    :raises TimeoutError: if the callback has not applied the command in time,
+                          the command is dropped
+    """
+    global commands_executed, command_wait_sum
+    prepare_command(command)
+    if stream is None or not stream.active:
+        with lock:
+            # the stream may have been started in the meantime
+            if stream is None or not stream.active:
+                commands.put(command)
+                drain_commands()
+    if not command.done.is_set():
+        start = timer()
+        commands.put(command)
+        if not command.done.wait(timeout):
+            if command.claim():
+                # the callback skips the command
+                logging.warning(f"{command} has not been applied within {timeout}s")
+                raise TimeoutError(f"{command.op.value} has not been applied in time")
+            # the callback has taken the command in the meantime
+            command.done.wait()
+        commands_executed += 1
+        command_wait_sum += timer() - start
+
+    if command.error is not None:
+        raise command.error
+
+
+def prepare_command(command: Command):
+    """
+    Decompress and prefetch recordings that are about to be played or recorded.
+
+    :param command: the command that will be executed
+    """
+    if command.op == Op.Batch:
+        for c in command.value:
+            prepare_command(c)
+    elif command.op in [Op.Loop, Op.Record, Op.Overdub]:
+        r = get_recordings().get(command.key)
+        if r is not None:
+            r.last_used = time.monotonic()
+            decompress_recording(command.key)
+            if command.op == Op.Record:
+                # new frames are appended after the trimmed frames, appending
+                # drops the undo history anyway
+                reclaim_recording(command.key, drop_history=True)
+            elif command.op == Op.Overdub:
+                load_recording(command.key)
+            r.prefetch()
+
+
+def get_recordings() -> Dict[str, Recording]:
+    """
+    Get the recordings without blocking the callback. The returned dict must
+    not be modified.
+
+    :return: dict with all recordings
+    """
+    return recordings_snapshot
+
+
+def new_storage() -> RingAccessVector:
+    """
+    Create an empty storage of the configured kind and precision.
+    """
+    if storage == "growing":
+        return RingGrowingArray(PRECISIONS[precision])
+    return RingBlockArena(storage_pool)
+
+
+def new_recording() -> Recording:
+    """
+    Create an empty recording with the configured storage.
+    """
+    return Recording(new_storage())
+
+
+def spill_recordings():
+    """
+    Move recordings that exceed the spill threshold from memory to disk.
+    """
+    threshold = int(spill_threshold * stream.samplerate)
+    for key, r in get_recordings().items():
+        if isinstance(r.data, RingFileArray) or len(r.data) <= threshold:
+            continue
+        if r.state == State.Overdub or r.data.history != (0, 0):
+            # the undo history is kept in memory
+            continue
+
+        # copy the data here and only swap it in the callback
+        data = RingFileArray(session_dir)
+        copied = copy_elements(r.data, data)
+        try:
+            execute(Command(Op.SetData, key, (data, copied)))
+            logging.info(f"Moved recording {key} to {data.path}")
+        except (KeyError, ValueError, TimeoutError):
+            # recording has been deleted or is being written, retried later
+            data.clear()
+
+
+def get_memory_usage() -> int:
+    """
+    Get the memory used by all recordings.
+
+    :return: number of bytes
+    """
+    return sum(r.data.nbytes for r in get_recordings().values())
+
+
+def scheduled_keys() -> set:
+    """
+    Get the keys of recordings that scheduled commands refer to.
+    """
+    keys = set()
+    pending = list(schedule)
+    while len(pending) > 0:
+        command = pending.pop()
+        if command.op == Op.Batch:
+            pending += command.value
+        else:
+            keys.add(command.key)
+    return keys
+
+
+def is_evictable(r: Recording) -> bool:
+    if r.state != State.Pause or len(r.data) == 0:
+        return False
+    if r.data.history != (0, 0):
+        # the undo history is kept in memory
+        return False
+    return not isinstance(r.data, (RingFileArray, RingCompressedArray))
+
+
+def enforce_memory_budget():
+    """
+    Compress the least recently used paused recordings while all recordings
+    exceed the memory budget. If there is a session directory, they are moved to
+    disk instead.
+    """
+    global memory_warning_logged
+    usage = get_memory_usage()
+    if usage <= memory_budget:
+        memory_warning_logged = False
+        return
+
+    scheduled = scheduled_keys()
+    candidates = [
+        (key, r)
+        for key, r in get_recordings().items()
+        if key not in scheduled and is_evictable(r)
+    ]
+    candidates.sort(key=lambda pair: pair[1].last_used)
+    for key, r in candidates:
+        if usage <= memory_budget:
+            return
+
+        nbytes = r.data.nbytes
+        if session_dir is not None:
+            data = RingFileArray(session_dir)
+            copied = copy_elements(r.data, data)
+        else:
+            data = RingCompressedArray(r.data)
+            copied = len(data)
+        try:
+            execute(Command(Op.SetData, key, (data, copied)))
+        except (KeyError, ValueError, TimeoutError):
+            # recording has been deleted or is being used, retried later
+            data.clear()
+            continue
+        usage -= nbytes - data.nbytes
+        logging.info(f"Evicted recording {key} ({nbytes} bytes) from memory")
+
+    if usage > memory_budget and not memory_warning_logged:
+        logging.warning(
+            f"Recordings use {usage} bytes of memory, which exceeds the budget of "
+            f"{memory_budget} bytes"
         )
+        memory_warning_logged = True
+
+
+def decompress_recording(key: str):
+    """
+    Move a compressed recording back to memory, so that it can be played.
+
+    :param key: the key of the recording
+    """
+    r = get_recordings().get(key)
+    if r is None or not isinstance(r.data, RingCompressedArray):
+        return
+
+    data = new_storage()
+    copied = copy_elements(r.data, data)
+    execute(Command(Op.SetData, key, (data, copied)))
+    logging.info(f"Decompressed recording {key}")
+
+
+def load_recording(key: str):
+    """
+    Copy a recording from disk or a growing array to chunks in memory, which
+    can be changed in place by overdubbing.
+
+    :param key: the key of the recording
+    """
+    r = get_recordings().get(key)
+    if r is None or isinstance(r.data, RingBlockArena) or r.state in WRITING:
+        return
+
+    data = RingBlockArena(storage_pool)
+    copied = copy_elements(r.data, data)
+    try:
+        execute(Command(Op.SetData, key, (data, copied)))
+        logging.info(f"Loaded recording {key} into memory for overdubbing")
+    except (KeyError, ValueError, TimeoutError):
+        # recording has been deleted or is being written, fails when overdubbing
+        data.clear()
+
+
+def reclaim_recording(key: str, drop_history: bool = False):
+    """
+    Copy the frames of a trimmed recording to a new storage, so that the trimmed
+    frames are released.
+
+    :param key: the key of the recording
+    :param drop_history: whether recordings with undo history are copied as
+                         well, which drops the history
+    """
+    r = get_recordings().get(key)
+    if r is None or r.data.trimmed == 0 or r.state in WRITING:
+        return
+    if r.data.history != (0, 0) and not drop_history:
+        return
+
+    src = r.data
+    if isinstance(src, RingCompressedArray):
+        data = RingCompressedArray(src)
+        copied = len(data)
+    else:
+        if isinstance(src, RingFileArray):
+            data = RingFileArray(src.directory)
+        else:
+            data = new_storage()
+        copied = copy_elements(src, data)
+    # src is cleared when the new storage is set
+    trimmed = src.trimmed
+    try:
+        execute(Command(Op.SetData, key, (data, copied)))
+        logging.info(f"Released {trimmed} trimmed frames of recording {key}")
+    except (KeyError, ValueError, TimeoutError):
+        # recording has been deleted or is being written, retried later
+        data.clear()
+
+
+def reclaim_recordings():
+    """
+    Release the trimmed frames of all recordings.
+    """
+    for key in list(get_recordings()):
+        reclaim_recording(key)
+
+
+def write_recordings():
+    """
+    Move the recorded frames from the input ring to the recordings and release
+    the frames that are no longer needed.
+    """
+    global state_version, written_revisions
+    ring = input_ring
+    pos = ring.write_pos
+    # frames of recordings that start later are after pos
+    oldest = pos
+    revisions = 0
+    for r in get_recordings().values():
+        if r.ring is ring:
+            r.write_pending()
+        if r.ring is ring:
+            oldest = min(oldest, r.ring_written)
+        revisions += r.revision
+    ring.release(oldest)
+    if revisions != written_revisions:
+        # e.g. overdubs that have been finished after the offset
+        written_revisions = revisions
+        state_version += 1
+
+
+def writer(interval: float = 0.01):
+    """
+    Periodically move recorded frames until the stream is closed.
+
+    :param interval: time between runs in seconds
+    """
+    while not writer_stop.wait(interval):
+        try:
+            write_recordings()
+        except Exception:
+            logging.exception("Writing recordings failed")
+
+
+def save_session():
+    """
+    Save all recordings in the session directory.
+    """
+    session.save_session(session_dir, get_recordings(), stream.samplerate)
+
+
+def remove_spill_files():
+    """
+    Remove the files in the session directory that belong neither to a
+    recording nor to a saved session, e.g. of spills that have been
+    interrupted.
+    """
+    used_files = {
+        os.path.basename(r.data.path)
+        for r in recordings.values()
+        if isinstance(r.data, RingFileArray) and r.data.path is not None
+    }
+    used_files.update(
+        entry["file"] for entry in session.load_metadata(session_dir).values()
+    )
+    try:
+        session.remove_unused_files(session_dir, used_files)
+    except OSError:
+        logging.exception("Could not remove spilled recordings")
+
+
+def restore_session():
+    """
+    Add the recordings of the session directory.
+    """
+    restored = session.load_session(session_dir)
+    if len(restored) > 0:
+        execute(Command(Op.Restore, value=restored))
+
+
+def housekeeping(interval: float = 1.0):
+    """
+    Periodically run background tasks until the stream is closed.
+
+    :param interval: time between runs in seconds
+    """
+    last_save = timer()
+    while not housekeeping_stop.wait(interval):
+        try:
+            if spill_threshold is not None:
+                spill_recordings()
+            reclaim_recordings()
+            if memory_budget is not None:
+                enforce_memory_budget()
+            if autosave_interval is not None and (
+                timer() - last_save >= autosave_interval
+            ):
+                save_session()
+                last_save = timer()
+        except Exception:
+            logging.exception("Housekeeping failed")
+
+
+def get_devices_list():
+    return backend.get_devices_list()
 
 
 def stream_start(
     device: Union[int, str, Tuple[Union[int, str], Union[int, str]]],
     latency="high",
     channels=1,
+    vectorized_mixer=True,
+    session_directory: Optional[str] = None,
+    spill_threshold_seconds: Optional[float] = None,
+    autosave_interval_seconds: Optional[float] = None,
+    backend_name: str = "sounddevice",
+    backend_options: Optional[dict] = None,
+    quantize: Union[str, Quantize] = Quantize.Block,
+    input_ring_seconds: Optional[float] = 2.0,
+    storage_precision: str = "float32",
+    memory_budget_mb: Optional[float] = None,
+    storage_kind: str = "arena",
+    record_offset_seconds: float = 0.0,
+    adaptive_latency: Union[bool, dict, None] = None,
 ):
-    global stream, recordings
+    global stream, recordings, mixer, session_dir, spill_threshold, record_offset
+    global autosave_interval, housekeeping_thread, default_quantize, state_version
+    global input_ring, writer_thread, precision, storage_pool, memory_budget, storage
+    global start_options, latency_controller, controller_thread, controller_stop
     if stream is not None:
         return None
+    # only the arguments at this point
+    start_options = dict(locals())
 
-    # restart sounddevice to reload available devices
-    restart_sounddevice()
-
-    if isinstance(device, (list, tuple)):
-        stream_device = (
-            search_device(device[0], kind="input"),
-            search_device(device[1], kind="output"),
-        )
-    else:
-        stream_device = (
-            search_device(device, kind="input"),
-            search_device(device, kind="output"),
-        )
+    default_quantize = Quantize(quantize)
+    if storage_precision not in PRECISIONS:
+        raise ValueError(f"Unknown storage precision '{storage_precision}'")
+    precision = storage_precision
+    if storage_kind not in STORAGES:
+        raise ValueError(f"Unknown storage '{storage_kind}'")
+    storage = storage_kind
+    if np.dtype(storage_pool.dtype) != PRECISIONS[precision]:
+        storage_pool = ChunkPool(dtype=PRECISIONS[precision])
+    mixer = Mixer(channels=channels) if vectorized_mixer else None
 
-    logging.info("Using devices")
-    logging.info(f"> Input: {stream_device[0]}")
-    logging.info(f"> Output: {stream_device[1]}")
+    if session_directory is not None:
+        session_dir = os.path.expanduser(session_directory)
+        os.makedirs(session_dir, exist_ok=True)
+    spill_threshold = spill_threshold_seconds if session_dir is not None else None
+    memory_budget = (
+        None if memory_budget_mb is None else int(memory_budget_mb * 2**20)
+    )
+    autosave_interval = autosave_interval_seconds if session_dir is not None else None
+    if autosave_interval is not None and len(recordings) == 0 and not restarting:
+        restore_session()
 
     if __debug__:
         logging.warning("Debug mode is enabled (__debug__).")
 
-    stream = sd.Stream(
-        callback=callback,
-        device=stream_device,
+    stream = backend.create_backend(
+        backend_name,
+        callback,
+        device,
         latency=latency,
         channels=channels,
-        dtype="float32",
+        **({} if backend_options is None else backend_options),
     )
+
+    record_offset = max(0, round(record_offset_seconds * stream.samplerate))
+    if input_ring_seconds is not None:
+        input_ring = FrameRing(int(input_ring_seconds * stream.samplerate), channels)
+        for r in recordings.values():
+            if r.state == State.Record:
+                r.start_recording(input_ring, record_offset)
+            elif r.state == State.Overdub:
+                r.start_overdub(input_ring, record_offset)
+        writer_stop.clear()
+        writer_thread = Thread(target=writer, daemon=True)
+        writer_thread.start()
+    elif record_offset > 0:
+        logging.warning("The record offset is only applied with an input ring")
+
     stream.start()
+    state_version += 1
     logging.info("Started stream")
 
+    housekeeping_stop.clear()
+    housekeeping_thread = Thread(target=housekeeping, daemon=True)
+    housekeeping_thread.start()
+
+    if adaptive_latency and controller_thread is None:
+        options = adaptive_latency if isinstance(adaptive_latency, dict) else {}
+        latency_controller = LatencyController(**options)
+        controller_stop = Event()
+        controller_thread = Thread(
+            target=adapt_latency,
+            args=(latency_controller, controller_stop),
+            daemon=True,
+        )
+        controller_thread.start()
+
+
+def stream_close(restart: bool = False):
+    """
+    Stop and close the stream.
+
+    :param restart: whether the stream is started again right away, then the
+                    session is not saved and scheduled commands are kept
+    """
+    global stream, housekeeping_thread, state_version, input_ring, writer_thread
+    global controller_thread, latency_controller
+    if not restart and controller_thread is not None:
+        # not joined, the thread may be waiting for the lock to restart the stream
+        controller_stop.set()
+        controller_thread = None
+        latency_controller = None
+
+    if housekeeping_thread is not None:
+        housekeeping_stop.set()
+        housekeeping_thread.join()
+        housekeeping_thread = None
 
-def stream_close():
-    global stream
     if stream is not None:
         stream.stop()
+        if writer_thread is not None:
+            writer_stop.set()
+            writer_thread.join()
+            writer_thread = None
+        if input_ring is not None:
+            # move the remaining frames, recordings continue on the next start
+            for r in recordings.values():
+                r.stop_recording(delayed=False)
+            input_ring = None
+        if autosave_interval is not None and not restart:
+            try:
+                save_session()
+            except Exception:
+                logging.exception("Could not save session")
+        elif session_dir is not None and not restart:
+            remove_spill_files()
         stream.close()
         logging.info("Closed stream")
         stream = None
+        state_version += 1
+        if not restart:
+            # apply commands that have not been consumed by the callback
+            flush_schedule()
+            drain_commands()
+
+
+def stream_restart(**changes):
+    """
+    Restart the stream with other arguments of stream_start. Recordings, their
+    states and playback positions and scheduled commands are kept.
+
+    :param changes: the arguments that are changed
+    :raises ValueError: if the stream cannot be started with the changed
+                        arguments, it is started with the previous ones instead
+    """
+    global callback_priority, restarts, restarting
+    with lock:
+        if stream is None:
+            raise ValueError("The stream is not running")
+        options = dict(start_options)
+        stream_close(restart=True)
+        # the callback may run in a new thread
+        callback_priority = applied_priority
+        restarts += 1
+        restarting = True
+        try:
+            stream_start(**{**options, **changes})
+        except Exception as e:
+            callback_priority = applied_priority
+            stream_start(**options)
+            raise ValueError(f"Could not restart the stream: {e}")
+        finally:
+            restarting = False
+
+
+def get_latency() -> float:
+    """
+    Get the latency of the running stream in seconds.
+    """
+    value = stream.latency
+    if isinstance(value, (list, tuple)):
+        # input and output latency of sounddevice
+        return max(value)
+    return float(value)
+
+
+def adapt_latency(controller: LatencyController, stop: Event):
+    """
+    Periodically let the latency controller check the telemetry of the stream
+    and restart the stream with the latency that it chooses.
+
+    :param controller: the controller
+    :param stop: set when the stream is closed
+    """
+    while not stop.wait(controller.interval):
+        try:
+            if stream is None or not stream.active or block_frames == 0:
+                continue
+            current = get_latency()
+            xruns = sum(status_counter.counts[flag] for flag in XRUN_FLAGS)
+            duration = duration_stats.window_histogram.quantile(0.99)
+            new = controller.check(
+                current, xruns, duration, block_frames / stream.samplerate
+            )
+            if new is None:
+                continue
+
+            changes = {"latency": new}
+            options = start_options.get("backend_options") or {}
+            if "blocksize" in options:
+                # the latency of backends without PortAudio is the block size
+                blocksize = round(options["blocksize"] * new / current)
+                changes["backend_options"] = {
+                    **options,
+                    "blocksize": min(max(blocksize, 32), 8192),
+                }
+            logging.info(f"Restarting the stream with a latency of {new:.4f}s")
+            stream_restart(**changes)
+            if new < current:
+                controller.applied(current, get_latency())
+        except ValueError as e:
+            logging.warning(f"Could not change the latency: {e}")
+        except Exception:
+            logging.exception("Adapting the latency failed")
+
+
+def calibrate_latency(max_delay_seconds: float = 1.0) -> dict:
+    """
+    Measure the round-trip latency by playing a chirp and finding it in the
+    input. The output is replaced by the chirp during the measurement. The
+    result is used as the record offset of new recordings.
+
+    :param max_delay_seconds: maximum latency that can be measured
+    :raises ValueError: if the stream is not running or the chirp has not been
+                        found in the input
+    :return: dict with the latency in frames and seconds and the correlation
+    """
+    global active_calibration, record_offset
+    with lock:
+        if stream is None or not stream.active:
+            raise ValueError("The stream is not running")
+
+        samplerate = stream.samplerate
+        signal = calibration.chirp(samplerate)
+        max_delay = int(max_delay_seconds * samplerate)
+        channels = start_options.get("channels", 1)
+        measurement = calibration.Calibration(signal, max_delay, channels)
+        active_calibration = measurement
+        timeout = (signal.shape[0] + max_delay) / samplerate + 1.0
+        try:
+            if not measurement.done.wait(timeout):
+                raise ValueError("The calibration has not finished in time")
+        finally:
+            active_calibration = None
+
+        frames, correlation = measurement.result()
+        if correlation < calibration.MIN_CORRELATION:
+            raise ValueError(
+                f"The calibration signal has not been found in the input "
+                f"(correlation {correlation:.2f})"
+            )
+        record_offset = frames
+        logging.info(f"Measured a round-trip latency of {frames} frames")
+        return {
+            "frames": frames,
+            "seconds": frames / samplerate,
+            "correlation": correlation,
+        }
 
 
 def get_stream_info_dict():
@@ -143,6 +1089,15 @@ def get_stream_info_dict():
         "active": False if stream is None else stream.active,
         "samplerate": 0 if stream is None else stream.samplerate,
         "device": -1 if stream is None else stream.device,
+        "frame": frame_counter,
+        "quantize": default_quantize.value,
+        "precision": precision,
+        "storage": storage,
+        "memory": get_memory_usage(),
+        "memory_budget": memory_budget,
+        "record_offset": record_offset,
+        "latency": None if stream is None else get_latency(),
+        "adaptive_latency": latency_controller is not None,
         "duration_stats": duration_stats.get_stats(),
     }
 
@@ -152,10 +1107,152 @@ def get_stream_info_dict():
     return info
 
 
+def collect_metrics():
+    """
+    Get the metrics of the stream and all recordings.
+
+    :return: the metrics in text format
+    """
+    stats = duration_stats
+    ring = input_ring
+    recording_items = list(get_recordings().items())
+    return "".join(
+        [
+            metrics.format_histogram(
+                "slooper_callback_duration_seconds",
+                "Duration of the stream callback",
+                stats.histogram,
+                stats.total_mean * stats.total_count,
+            ),
+            metrics.format_metric(
+                "slooper_callback_status_total",
+                "counter",
+                "Number of callbacks with the status flag (xruns)",
+                [({"flag": k}, v) for k, v in status_counter.counts.items()],
+            ),
+            metrics.format_metric(
+                "slooper_stream_active",
+                "gauge",
+                "Whether the stream is running",
+                [({}, int(stream is not None and stream.active))],
+            ),
+            metrics.format_metric(
+                "slooper_commands_total",
+                "counter",
+                "Number of commands applied by the callback",
+                [({}, commands_executed)],
+            ),
+            metrics.format_metric(
+                "slooper_command_wait_seconds_total",
+                "counter",
+                "Total time handlers waited for the callback to apply commands",
+                [({}, command_wait_sum)],
+            ),
+            metrics.format_metric(
+                "slooper_input_ring_overflows_total",
+                "counter",
+                "Number of input blocks that have been dropped as the ring was full",
+                [({}, 0 if ring is None else ring.overflows)],
+            ),
+            metrics.format_metric(
+                "slooper_input_ring_overflow_frames_total",
+                "counter",
+                "Number of input frames that have been dropped as the ring was full",
+                [({}, 0 if ring is None else ring.overflow_frames)],
+            ),
+            metrics.format_metric(
+                "slooper_input_ring_frames",
+                "gauge",
+                "Number of input frames that have not been written to recordings",
+                [({}, 0 if ring is None else len(ring))],
+            ),
+            metrics.format_metric(
+                "slooper_recording_frames",
+                "gauge",
+                "Number of frames of the recording",
+                [
+                    ({"key": k, "state": r.state.value}, len(r.data))
+                    for k, r in recording_items
+                ],
+            ),
+            metrics.format_metric(
+                "slooper_recording_memory_bytes",
+                "gauge",
+                "Memory used by the recording",
+                [({"key": k}, r.data.nbytes) for k, r in recording_items],
+            ),
+            metrics.format_metric(
+                "slooper_recording_disk_bytes",
+                "gauge",
+                "Disk space used by the recording",
+                [
+                    ({"key": k}, r.data.disk_nbytes)
+                    for k, r in recording_items
+                    if isinstance(r.data, RingFileArray)
+                ],
+            ),
+            metrics.format_metric(
+                "slooper_chunk_pool_free_bytes",
+                "gauge",
+                "Memory of released chunks that are kept for reuse",
+                [({}, storage_pool.free_nbytes)],
+            ),
+            metrics.format_metric(
+                "slooper_stream_latency_seconds",
+                "gauge",
+                "Latency of the stream",
+                [] if stream is None else [({}, get_latency())],
+            ),
+            metrics.format_metric(
+                "slooper_stream_restarts_total",
+                "counter",
+                "Number of restarts of the stream to change its latency",
+                [({}, restarts)],
+            ),
+            metrics.format_metric(
+                "slooper_memory_budget_bytes",
+                "gauge",
+                "Maximum memory of all recordings",
+                [] if memory_budget is None else [({}, memory_budget)],
+            ),
+        ]
+    )
+
+
+metrics.collectors.append(collect_metrics)
+
+
 def get_config_path():
     return Path(os.getenv("SLOOPER_CONF", default=os.path.expanduser("~/.slooper")))
 
 
+def save_config_value(key: str, value):
+    """
+    Change a single top-level value in the configuration file, all other
+    lines (including comments) are kept.
+
+    :param key: the key
+    :param value: the new value
+    """
+    config_path = get_config_path()
+    line = yaml.safe_dump({key: value}, default_flow_style=True).strip()
+    if line.startswith("{"):
+        line = line[1:-1]
+    try:
+        with open(config_path, "r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    for i, current in enumerate(lines):
+        if current.startswith(f"{key}:"):
+            lines[i] = line
+            break
+    else:
+        lines.append(line)
+    with open(config_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
 def load_config():
     config_path = get_config_path()
     try:
@@ -173,8 +1270,17 @@ def load_config():
         traceback.print_exception(type(e), e, e.__traceback__)
 
 
+def stream_exit():
+    """
+    Close the stream at exit and remove the recordings, including the spilled
+    ones that no session keeps.
+    """
+    stream_close()
+    execute(Command(Op.Clear))
+
+
 # make sure to properly close stream at exit
-atexit.register(stream_close)
+atexit.register(stream_exit)
 
 if __name__ == "__main__":
     logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
@@ -186,18 +1292,22 @@ if __name__ == "__main__":
         tracer.start()
         tracer.enable_thread_tracing()
 
-    stream_start(device=cfg["device"])
+    stream_start(
+        device=cfg["device"],
+        backend_name=cfg.get("backend", "sounddevice"),
+        backend_options=cfg.get("backend-options", None),
+    )
 
     # record for a few seconds
     logging.info("Record")
-    recordings["a"].state = State.Record
-    sd.sleep(int(1000 * 5))
+    execute(Command(Op.Record, "a", new_recording()))
+    time.sleep(5)
 
     # play it back two times
     logging.info("Playback")
-    recordings["a"].state = State.Loop
-    sd.sleep(int(1000 * 10))
-    sd.stop()
+    execute(Command(Op.Loop, "a"))
+    time.sleep(10)
+    stream_close()
 
     if __debug__:
         # save tracer records
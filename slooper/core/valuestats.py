@@ -1,33 +1,181 @@
+from collections import deque
+import math
+
 import numpy as np
 
 
+class LogHistogram:
+    """
+    Counts of positive values in logarithmically spaced buckets.
+    """
+
+    def __init__(
+        self, min_value: float = 1e-6, max_value: float = 10.0, buckets_per_decade=20
+    ):
+        """
+        Initialize the histogram.
+
+        :param min_value: lower edge of the first bucket, smaller values are
+                          counted in an underflow bucket
+        :param max_value: upper edge of the last bucket, larger values are
+                          counted in an overflow bucket
+        :param buckets_per_decade: number of buckets per factor of 10
+        """
+        self.min_value = min_value
+        self.buckets_per_decade = buckets_per_decade
+        num_buckets = math.ceil(math.log10(max_value / min_value) * buckets_per_decade)
+        # edges[i] is the upper edge of bucket i, the last bucket is unbounded
+        self.edges = np.append(
+            min_value * 10 ** (np.arange(num_buckets + 1) / buckets_per_decade),
+            np.inf,
+        )
+        self.counts = [0] * (num_buckets + 2)
+
+    def bucket(self, value: float) -> int:
+        """
+        Get the index of the bucket of a value.
+
+        :param value: the value
+        :return: the bucket index
+        """
+        if value <= self.min_value:
+            return 0
+        idx = math.ceil(math.log10(value / self.min_value) * self.buckets_per_decade)
+        return min(idx, len(self.counts) - 1)
+
+    def quantile(self, q: float) -> float:
+        """
+        Get an upper bound of the q-quantile without sorting.
+
+        :param q: the quantile in [0, 1]
+        :return: upper edge of the bucket that contains the quantile
+        """
+        cumulative = np.cumsum(self.counts)
+        if cumulative[-1] == 0:
+            return 0.0
+        idx = np.searchsorted(cumulative, q * cumulative[-1])
+        return self.edges[min(idx, self.edges.shape[0] - 2)].item()
+
+
 class ValueStats:
     """
-    Insert values into a ring and get aggregated statistics.
+    Insert values and get aggregated statistics of a sliding window and of all
+    values since the start. Inserting is O(1), queries do not sort.
     """
 
-    def __init__(self, capacity, dtype):
-        self.data = np.empty(capacity, dtype=dtype)
+    def __init__(self, capacity: int, **histogram_kwargs):
+        """
+        Initialize the statistics.
+
+        :param capacity: number of values in the sliding window
+        :param histogram_kwargs: arguments of the LogHistogram buckets
+        """
+        # python lists are faster than numpy arrays for single element access
+        self.data = [0.0] * capacity
+        self.buckets = [0] * capacity
         self.count = 0
         self.idx = 0
 
+        # sliding window
+        self.window_histogram = LogHistogram(**histogram_kwargs)
+        self.window_sum = 0.0
+        self.window_sum_sq = 0.0
+        # monotonic queues with the sequence numbers of min and max candidates
+        self.window_min = deque()
+        self.window_max = deque()
+
+        # since start
+        self.histogram = LogHistogram(**histogram_kwargs)
+        self.total_count = 0
+        self.total_mean = 0.0
+        self.total_m2 = 0.0
+        self.total_min = math.inf
+        self.total_max = -math.inf
+
     def insert(self, value):
+        value = float(value)
+        capacity = len(self.data)
+        seq = self.total_count
+        bucket = self.window_histogram.bucket(value)
+
+        # remove the oldest value from the window
+        if self.count == capacity:
+            old = self.data[self.idx]
+            self.window_histogram.counts[self.buckets[self.idx]] -= 1
+            self.window_sum -= old
+            self.window_sum_sq -= old * old
+            if self.window_min[0] == seq - capacity:
+                self.window_min.popleft()
+            if self.window_max[0] == seq - capacity:
+                self.window_max.popleft()
+        else:
+            self.count += 1
+
+        # add the value to the window
         self.data[self.idx] = value
-        self.idx = (self.idx + 1) % self.data.shape[0]
-        self.count = min(self.count + 1, self.data.shape[0])
+        self.buckets[self.idx] = bucket
+        self.idx = (self.idx + 1) % capacity
+        self.window_histogram.counts[bucket] += 1
+        self.window_sum += value
+        self.window_sum_sq += value * value
+        while self.window_min and self.data[self.window_min[-1] % capacity] >= value:
+            self.window_min.pop()
+        self.window_min.append(seq)
+        while self.window_max and self.data[self.window_max[-1] % capacity] <= value:
+            self.window_max.pop()
+        self.window_max.append(seq)
+
+        # update the totals (Welford's algorithm)
+        self.histogram.counts[bucket] += 1
+        self.total_count += 1
+        delta = value - self.total_mean
+        self.total_mean += delta / self.total_count
+        self.total_m2 += delta * (value - self.total_mean)
+        self.total_min = min(self.total_min, value)
+        self.total_max = max(self.total_max, value)
 
     def get_stats(self):
         if self.count == 0:
             return {
                 "mean": 0,
                 "max": 0,
+                "min": 0,
                 "std": 0,
                 "99p": 0,
+                "total": {
+                    "count": 0,
+                    "mean": 0,
+                    "max": 0,
+                    "min": 0,
+                    "std": 0,
+                    "99p": 0,
+                    "99.9p": 0,
+                },
             }
 
+        capacity = len(self.data)
+        try:
+            window_max = self.data[self.window_max[0] % capacity]
+            window_min = self.data[self.window_min[0] % capacity]
+        except IndexError:
+            # the queues are being updated concurrently
+            window_max = max(self.data[: self.count])
+            window_min = min(self.data[: self.count])
+
+        mean = self.window_sum / self.count
         return {
-            "mean": self.data[: self.count].mean().item(),
-            "max": self.data[: self.count].max().item(),
-            "std": self.data[: self.count].std().item(),
-            "99p": np.percentile(self.data[: self.count], 99).item(),
+            "mean": mean,
+            "max": window_max,
+            "min": window_min,
+            "std": math.sqrt(max(self.window_sum_sq / self.count - mean * mean, 0)),
+            "99p": self.window_histogram.quantile(0.99),
+            "total": {
+                "count": self.total_count,
+                "mean": self.total_mean,
+                "max": self.total_max,
+                "min": self.total_min,
+                "std": math.sqrt(self.total_m2 / self.total_count),
+                "99p": self.histogram.quantile(0.99),
+                "99.9p": self.histogram.quantile(0.999),
+            },
         }
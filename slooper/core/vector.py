@@ -1,15 +1,97 @@
 from abc import ABC, abstractmethod
+from bisect import bisect_right
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import io
 import logging
-from typing import List, Optional
+from multiprocessing.shared_memory import SharedMemory
+import os
+import tempfile
+from threading import Lock
+import zlib
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
+import soundfile as sf
 
 
 class RingAccessVector(ABC):
     """
     Dynamic numpy vector of variable size with tail append and circular read access to elements.
+
+    Elements may be stored with a lower precision than the appended samples. Elements
+    that are read from the vector have to be multiplied with scale to get the samples.
     """
 
+    # value of one stored unit
+    scale: float = 1.0
+    # whether begin_layer and mix change the elements in place
+    mixable: bool = False
+
+    def trim(self, start: int, end: int):
+        """
+        Restrict the vector to a window of its elements without copying them.
+        Indices of all methods refer to the window afterwards.
+
+        :param start: index of the first element that is kept
+        :param end: index after the last element that is kept
+        :raises ValueError: if the window is invalid or the vector cannot be trimmed
+        """
+        raise ValueError(f"{type(self).__name__} cannot be trimmed")
+
+    @property
+    def trimmed(self) -> int:
+        """
+        Get the number of elements that are hidden by trim and still stored.
+        """
+        return 0
+
+    def begin_layer(self):
+        """
+        Start a layer of changes by mix that can be undone as a whole.
+
+        :raises ValueError: if the vector cannot be changed in place
+        """
+        raise ValueError(f"{type(self).__name__} does not support overdubbing")
+
+    def end_layer(self):
+        """
+        Finish the current layer and add it to the undo history.
+        """
+        pass
+
+    def mix(self, x: np.ndarray, idx: int):
+        """
+        Add samples to the elements from an index on, wrapping around at the end.
+
+        :param x: float samples
+        :param idx: index of the first element
+        """
+        raise ValueError(f"{type(self).__name__} does not support overdubbing")
+
+    def undo(self) -> bool:
+        """
+        Revert the last layer.
+
+        :return: whether there was a layer to undo
+        """
+        return False
+
+    def redo(self) -> bool:
+        """
+        Apply the last undone layer again.
+
+        :return: whether there was a layer to redo
+        """
+        return False
+
+    @property
+    def history(self) -> Tuple[int, int]:
+        """
+        Get the number of layers that can be undone and redone.
+        """
+        return 0, 0
+
     @abstractmethod
     def set_idx(self, idx: int) -> bool:
         """
@@ -38,6 +120,35 @@ class RingAccessVector(ABC):
         """
         ...
 
+    @abstractmethod
+    def segments(self) -> List[np.ndarray]:
+        """
+        Get the data without copying it.
+
+        :return: list of arrays that hold all elements of this vector when
+                 concatenated. Later appends do not modify them, but mix
+                 changes the elements of the current layer in place.
+        """
+        ...
+
+    def read(self, start: int, n: int) -> np.ndarray:
+        """
+        Copy elements without changing the index. Only the requested elements
+        are read from the storage.
+
+        :param start: index of the first element
+        :param n: number of elements
+        :return: array with the elements in the dtype of the vector
+        """
+        return np.concatenate(window_segments(self.segments(), start, start + n))
+
+    def reading(self):
+        """
+        Get a context in which the arrays returned by segments are not reused
+        for other data.
+        """
+        return nullcontext()
+
     @abstractmethod
     def take(self, n: int) -> Optional[np.ndarray]:
         """
@@ -48,6 +159,35 @@ class RingAccessVector(ABC):
         """
         ...
 
+    @abstractmethod
+    def clear(self):
+        """
+        Remove all elements from the vector.
+        """
+        ...
+
+    def close(self):
+        """
+        Release the resources of the vector without discarding persistent data.
+        """
+        self.clear()
+
+    def prefetch(self):
+        """
+        Hint that the elements will be read soon.
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def nbytes(self) -> int:
+        """
+        Get the memory used by the vector.
+
+        :return: number of bytes of allocated memory
+        """
+        ...
+
     @abstractmethod
     def __len__(self) -> int:
         """
@@ -58,62 +198,189 @@ class RingAccessVector(ABC):
         ...
 
 
-class RingGrowingArray(RingAccessVector):
+def window_segments(
+    segments: List[np.ndarray], start: int, end: int
+) -> List[np.ndarray]:
+    """
+    Get the elements of segments within a window.
+
+    :param segments: arrays that hold the elements when concatenated
+    :param start: index of the first element
+    :param end: index after the last element
+    :return: views of the elements
+    """
+    visible = []
+    offset = 0
+    for segment in segments:
+        segment_end = offset + segment.shape[0]
+        if segment_end > start and offset < end:
+            visible.append(segment[max(start - offset, 0) : end - offset])
+        offset = segment_end
+    return visible
+
+
+class RingWindowVector(RingAccessVector):
+    """
+    Vector that stores size elements of which a window can be visible.
+
+    Subclasses keep the number of stored elements in size and the playback index
+    within the stored elements in idx.
+    """
+
+    size: int
+    idx: int
+    # first visible element and the element after the last visible element,
+    # None for all elements up to size
+    trim_start: int = 0
+    trim_end: Optional[int] = None
+
+    def window(self, size: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Get the visible elements.
+
+        :param size: number of stored elements, e.g. read before other fields.
+                     Defaults to the current size.
+        :return: index of the first and after the last visible element
+        """
+        if size is None:
+            size = self.size
+        end = size if self.trim_end is None else min(self.trim_end, size)
+        return self.trim_start, end
+
+    def trim(self, start: int, end: int):
+        first, last = self.window()
+        if not 0 <= start < end <= last - first:
+            raise ValueError(
+                f"Invalid window [{start}, {end}) of {last - first} elements"
+            )
+        self.trim_start = first + start
+        self.trim_end = first + end
+        self.idx = self.trim_start
+
+    @property
+    def trimmed(self):
+        return self.size - len(self)
+
+    def reset_window(self):
+        self.trim_start = 0
+        self.trim_end = None
+
+    def set_idx(self, idx):
+        start, end = self.window()
+        if idx < 0 or idx >= end - start:
+            logging.warning(
+                f"Could not set idx to {idx} in data of length {end - start}."
+            )
+            return False
+
+        self.idx = start + idx
+        return True
+
+    def __len__(self):
+        start, end = self.window()
+        return end - start
+
+
+class RingGrowingArray(RingWindowVector):
     """
     Numpy array that grows when adding elements would exceed its capacity.
+
+    The capacity grows geometrically, so appends take amortized constant time.
+    Reads that wrap around are collected in a reusable buffer, so the result of
+    take is only valid until the next call.
     """
 
-    def __init__(self, dtype):
+    def __init__(self, dtype=np.float32, scale: Optional[float] = None):
+        """
+        Initialize the data structure.
+
+        :param dtype: data type of the elements
+        :param scale: value of one stored unit. Defaults to full scale at 1.0
+                      for integer types and 1.0 for float types.
+        """
         self.segment_size = 100_000
+        self.growth_factor = 2
         self.capacity = self.segment_size
         self.data = np.empty((self.capacity, 1), dtype=dtype)
         self.size = 0
         self.idx = 0
+        self.out: Optional[np.ndarray] = None
 
-    def set_idx(self, idx):
-        if idx < 0 or idx >= self.size:
-            logging.warning(
-                f"Could not set idx to {idx} in data of length {self.size}."
-            )
-            return False
+        self.integer = np.issubdtype(self.data.dtype, np.integer)
+        if scale is None:
+            scale = 1.0 / np.iinfo(self.data.dtype).max if self.integer else 1.0
+        self.scale = scale
+        # buffer for the conversion of appended samples to integers
+        self.scratch: Optional[np.ndarray] = None
 
-        self.idx = idx
-        return True
+    def _grow(self, capacity: int, channels: int):
+        new_data = np.empty((capacity, channels), dtype=self.data.dtype)
+        new_data[: self.size] = self.data[: self.size]
+        self.data = new_data
+        self.capacity = capacity
 
     def append(self, x: np.ndarray):
         num_el = x.shape[0]
-        if self.size + num_el >= self.capacity:
-            self.capacity += self.segment_size
-            new_data = np.empty((self.capacity, *self.data.shape[1:]))
-            new_data[: self.size] = self.data[: self.size]
-            self.data = new_data
+        if self.size == 0 and x.shape[1] != self.data.shape[1]:
+            self._grow(self.capacity, x.shape[1])
+        if self.size + num_el > self.capacity:
+            capacity = max(self.capacity * self.growth_factor, self.size + num_el)
+            self._grow(capacity, self.data.shape[1])
 
-        self.data[self.size : self.size + num_el] = x
+        dst = self.data[self.size : self.size + num_el]
+        if self.integer:
+            self.scratch = quantize(x, dst, self.scale, self.scratch)
+        else:
+            dst[:] = x
         self.size += num_el
 
     def numpy(self):
-        return self.data[: self.size]
+        start, end = self.window()
+        return self.data[start:end]
+
+    def segments(self):
+        start, end = self.window()
+        return [self.data[start:end]]
 
     def take(self, n):
-        if self.size == 0:
+        start, end = self.window()
+        if end <= start:
             return None
 
-        curr_idx = self.idx
-        next_idx = self.idx + n
+        data = self.data
+        curr_idx = self.idx if start <= self.idx < end else start
+        if curr_idx + n <= end:
+            # fast case: just get the slice
+            self.idx = curr_idx + n if curr_idx + n < end else start
+            return data[curr_idx : curr_idx + n]
 
-        # already set next playback index
-        self.idx = next_idx % self.size
+        # slow case: get with wrap around
+        if self.out is None or self.out.shape[0] < n:
+            self.out = np.empty((n, data.shape[1]), dtype=data.dtype)
 
-        if next_idx <= self.size:
-            # fast case: just get the slice
-            return self.data[curr_idx:next_idx]
-        else:
-            # slow case: get with wrap around
-            data_slice = slice(curr_idx, next_idx)
-            return self.data[: self.size].take(data_slice, mode="wrap")
+        out = self.out[:n, : data.shape[1]]
+        idx = curr_idx
+        collected = 0
+        while collected < n:
+            m = min(n - collected, end - idx)
+            out[collected : collected + m] = data[idx : idx + m]
+            collected += m
+            idx = idx + m if idx + m < end else start
 
-    def __len__(self):
-        return self.size
+        self.idx = idx
+        return out
+
+    def clear(self):
+        # new array as the old one might still be referenced by a snapshot
+        self.capacity = self.segment_size
+        self.data = np.empty((self.capacity, self.data.shape[1]), dtype=self.data.dtype)
+        self.size = 0
+        self.idx = 0
+        self.reset_window()
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (0 if self.out is None else self.out.nbytes)
 
 
 class RingSegmentList(RingAccessVector):
@@ -141,7 +408,12 @@ class RingSegmentList(RingAccessVector):
         self.total_len += x.shape[0]
 
     def numpy(self):
-        return np.reshape(self.li, (self.total_len, -1))
+        # copy the list first as the callback might append to it concurrently
+        li = list(self.li)
+        return np.reshape(li, (sum(arr.shape[0] for arr in li), -1))
+
+    def segments(self):
+        return list(self.li)
 
     def set_idx(self, idx):
         if idx < 0 or idx >= self.total_len:
@@ -200,7 +472,7 @@ class RingSegmentList(RingAccessVector):
                 block = li_elem[self.elem_idx : self.elem_idx + available]
 
                 if blocks is None:
-                    blocks = np.empty((n, *block.shape[1:]))
+                    blocks = np.empty((n, *block.shape[1:]), dtype=block.dtype)
                     blocks[collected : collected + block.shape[0]] = block
                 else:
                     blocks[collected : collected + block.shape[0]] = block
@@ -220,5 +492,744 @@ class RingSegmentList(RingAccessVector):
         self.segment_idx = 0
         self.elem_idx = 0
 
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in list(self.li))
+
     def __len__(self):
         return self.total_len
+
+
+class ChunkPool:
+    """
+    Pool of preallocated chunks that can be shared and reused by multiple vectors.
+
+    Free chunks are taken from and returned to deques, which is atomic, so no
+    thread has to wait for another one. Chunks that are released while readers
+    hold segments are only reused after the last reader has finished.
+    """
+
+    def __init__(self, chunk_size: int = 2**16, dtype=np.float32, max_free: int = 64):
+        """
+        Initialize the pool.
+
+        :param chunk_size: number of frames per chunk
+        :param dtype: data type of the chunks
+        :param max_free: maximum number of released chunks per number of channels
+                         that are kept for reuse
+        """
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.max_free = max_free
+        # free chunks by number of channels
+        self.free: Dict[int, deque] = {}
+        # number of readers and the chunks that have been released while they
+        # were reading
+        self.readers = 0
+        self.retired: deque = deque()
+        self.readers_lock = Lock()
+
+    def acquire(self, channels: int) -> np.ndarray:
+        """
+        Get a chunk from the pool. Only allocates memory if there is no free chunk.
+
+        :param channels: number of channels of the chunk
+        :return: chunk with shape (chunk_size, channels) and uninitialized content
+        """
+        try:
+            return self.free[channels].pop()
+        except (KeyError, IndexError):
+            return np.empty((self.chunk_size, channels), dtype=self.dtype)
+
+    def release(self, chunk: np.ndarray):
+        """
+        Return a chunk to the pool. The chunk must not be part of a vector
+        anymore, so that readers that start afterwards cannot get it.
+
+        :param chunk: a chunk that has been acquired from this pool
+        """
+        if self.readers > 0:
+            # may be part of segments that are being read
+            self.retired.append(chunk)
+        else:
+            self._free(chunk)
+
+    def _free(self, chunk: np.ndarray):
+        free = self.free.setdefault(chunk.shape[1], deque())
+        if len(free) < self.max_free:
+            free.append(chunk)
+
+    @contextmanager
+    def reading(self):
+        """
+        Keep released chunks from being reused while segments are read.
+        """
+        with self.readers_lock:
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.readers_lock:
+                self.readers -= 1
+                if self.readers == 0:
+                    # chunks that are retired in the meantime wait for the
+                    # next reader
+                    while len(self.retired) > 0:
+                        self._free(self.retired.popleft())
+
+    @property
+    def free_nbytes(self) -> int:
+        """
+        Get the memory of the chunks that are kept for reuse.
+        """
+        return sum(
+            chunk.nbytes for free in list(self.free.values()) for chunk in list(free)
+        )
+
+
+default_chunk_pool = ChunkPool()
+
+
+class SharedChunkPool(ChunkPool):
+    """
+    Pool of chunks in shared memory that other processes can attach to by name.
+
+    Chunks are created ahead of time by refill and released chunks are only
+    removed by collect, so that the callback neither creates nor removes shared
+    memory blocks unless the reserve is exhausted.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 2**16,
+        dtype=np.float32,
+        reserve: int = 4,
+        channels: int = 1,
+    ):
+        """
+        Initialize the pool.
+
+        :param chunk_size: number of frames per chunk
+        :param dtype: data type of the chunks
+        :param reserve: number of chunks that are created ahead of time
+        :param channels: number of channels of the reserved chunks
+        """
+        super().__init__(chunk_size, dtype, max_free=0)
+        self.reserve_size = reserve
+        self.channels = channels
+        self.reserve: List[np.ndarray] = []
+        self.released: List[np.ndarray] = []
+        # shared memory block of each chunk by id
+        self.blocks: Dict[int, SharedMemory] = {}
+
+    def _create(self, channels: int) -> np.ndarray:
+        nbytes = self.chunk_size * channels * np.dtype(self.dtype).itemsize
+        block = SharedMemory(create=True, size=nbytes)
+        chunk = np.ndarray(
+            (self.chunk_size, channels), dtype=self.dtype, buffer=block.buf
+        )
+        self.blocks[id(chunk)] = block
+        return chunk
+
+    def acquire(self, channels: int) -> np.ndarray:
+        for i in range(len(self.reserve) - 1, -1, -1):
+            if self.reserve[i].shape[1] == channels:
+                return self.reserve.pop(i)
+        return self._create(channels)
+
+    def release(self, chunk: np.ndarray):
+        self.released.append(chunk)
+
+    def name(self, chunk: np.ndarray) -> str:
+        """
+        Get the name of the shared memory block of a chunk.
+
+        :param chunk: a chunk that has been acquired from this pool
+        :return: the name
+        """
+        return self.blocks[id(chunk)].name
+
+    def refill(self):
+        """
+        Create chunks until the reserve is full.
+        """
+        while len(self.reserve) < self.reserve_size:
+            self.reserve.append(self._create(self.channels))
+
+    def collect(self):
+        """
+        Remove the shared memory blocks of released chunks.
+        """
+        while len(self.released) > 0:
+            # pop is atomic, the callback may release chunks in the meantime
+            chunk = self.released.pop()
+            block = self.blocks.pop(id(chunk))
+            try:
+                block.close()
+            except BufferError:
+                # still referenced by a reader, the mapping is kept
+                pass
+            block.unlink()
+
+    def close(self):
+        """
+        Remove all shared memory blocks of reserved and released chunks.
+        """
+        self.released += self.reserve
+        self.reserve = []
+        self.collect()
+
+
+class RingBlockArena(RingWindowVector):
+    """
+    Chunks of fixed size from a pool that are filled consecutively.
+
+    Neither append nor take allocate memory unless a new chunk is required. Reads
+    that span multiple chunks are collected in a reusable buffer, so the result
+    of take is only valid until the next call.
+
+    Pools of float16 or int16 chunks reduce the memory of a recording. Samples
+    are converted to integers with the given scale when they are appended.
+
+    Chunks are copied before mix changes them for the first time in a layer,
+    the replaced chunks form the undo history. A layer only holds the chunks
+    that it has changed.
+    """
+
+    # maximum number of layers that can be undone
+    max_undo = 16
+    mixable = True
+
+    def __init__(self, pool: Optional[ChunkPool] = None, scale: Optional[float] = None):
+        """
+        Initialize the data structure.
+
+        :param pool: the pool to get chunks from. Defaults to a shared pool.
+        :param scale: value of one stored unit. Defaults to full scale at 1.0
+                      for integer chunks and 1.0 for float chunks.
+        """
+        self.pool = default_chunk_pool if pool is None else pool
+        self.chunks: List[np.ndarray] = []
+        self.size = 0
+        self.idx = 0
+        self.out: Optional[np.ndarray] = None
+
+        dtype = np.dtype(self.pool.dtype)
+        self.integer = np.issubdtype(dtype, np.integer)
+        if scale is None:
+            scale = 1.0 / np.iinfo(dtype).max if self.integer else 1.0
+        self.scale = scale
+        # buffer for the conversion of appended samples to integers
+        self.scratch: Optional[np.ndarray] = None
+        self.mix_buffer: Optional[np.ndarray] = None
+
+        # chunks that have been replaced in the current layer by their index
+        self.layer: Optional[Dict[int, np.ndarray]] = None
+        self.undo_layers: List[Dict[int, np.ndarray]] = []
+        self.redo_layers: List[Dict[int, np.ndarray]] = []
+
+    def append(self, x: np.ndarray):
+        if len(self.undo_layers) > 0 or len(self.redo_layers) > 0:
+            # the history does not contain the appended elements
+            self.drop_history()
+        chunk_size = self.pool.chunk_size
+        num_el = x.shape[0]
+        written = 0
+        while written < num_el:
+            chunk_idx, offset = divmod(self.size, chunk_size)
+            if chunk_idx == len(self.chunks):
+                self.chunks.append(self.pool.acquire(x.shape[1]))
+
+            n = min(chunk_size - offset, num_el - written)
+            dst = self.chunks[chunk_idx][offset : offset + n]
+            if self.integer:
+                self.scratch = quantize(
+                    x[written : written + n], dst, self.scale, self.scratch
+                )
+            else:
+                dst[:] = x[written : written + n]
+            written += n
+            # only increase the size after the data has been written
+            self.size += n
+
+    def begin_layer(self):
+        self.end_layer()
+        self._release_layers(self.redo_layers)
+        self.redo_layers = []
+        self.layer = {}
+
+    def end_layer(self):
+        layer = self.layer
+        self.layer = None
+        if layer is None or len(layer) == 0:
+            return
+        self.undo_layers.append(layer)
+        if len(self.undo_layers) > self.max_undo:
+            self._release_layers(self.undo_layers[:1])
+            del self.undo_layers[0]
+
+    def _writable(self, chunk_idx: int) -> np.ndarray:
+        chunk = self.chunks[chunk_idx]
+        if self.layer is not None and chunk_idx not in self.layer:
+            # copy on write, the previous chunk is kept for undo
+            copy = self.pool.acquire(chunk.shape[1])
+            copy[:] = chunk
+            self.layer[chunk_idx] = chunk
+            self.chunks[chunk_idx] = copy
+            chunk = copy
+        return chunk
+
+    def mix(self, x: np.ndarray, idx: int):
+        start, end = self.window()
+        if end <= start:
+            return
+
+        chunk_size = self.pool.chunk_size
+        pos = start + idx % (end - start)
+        done = 0
+        while done < x.shape[0]:
+            chunk_idx, offset = divmod(pos, chunk_size)
+            m = min(x.shape[0] - done, chunk_size - offset, end - pos)
+            dst = self._writable(chunk_idx)[offset : offset + m]
+            if self.integer:
+                if self.mix_buffer is None or self.mix_buffer.shape[0] < m:
+                    self.mix_buffer = np.empty((m, dst.shape[1]), dtype=np.float32)
+                buffer = self.mix_buffer[:m]
+                np.multiply(dst, np.float32(self.scale), out=buffer)
+                buffer += x[done : done + m]
+                self.scratch = quantize(buffer, dst, self.scale, self.scratch)
+            else:
+                dst += x[done : done + m]
+            done += m
+            pos = pos + m if pos + m < end else start
+
+    def _swap(self, layer: Dict[int, np.ndarray]) -> Dict[int, np.ndarray]:
+        replaced = {}
+        for chunk_idx, chunk in layer.items():
+            replaced[chunk_idx] = self.chunks[chunk_idx]
+            self.chunks[chunk_idx] = chunk
+        return replaced
+
+    def undo(self):
+        if self.layer is not None or len(self.undo_layers) == 0:
+            return False
+        self.redo_layers.append(self._swap(self.undo_layers.pop()))
+        return True
+
+    def redo(self):
+        if self.layer is not None or len(self.redo_layers) == 0:
+            return False
+        self.undo_layers.append(self._swap(self.redo_layers.pop()))
+        return True
+
+    @property
+    def history(self):
+        return len(self.undo_layers), len(self.redo_layers)
+
+    def _release_layers(self, layers: List[Dict[int, np.ndarray]]):
+        for layer in layers:
+            for chunk in layer.values():
+                self.pool.release(chunk)
+
+    def drop_history(self):
+        """
+        Release all chunks of the undo history.
+        """
+        self._release_layers(self.undo_layers + self.redo_layers)
+        self.undo_layers = []
+        self.redo_layers = []
+
+    def reading(self):
+        return self.pool.reading()
+
+    def numpy(self):
+        with self.reading():
+            segments = self.segments()
+            if len(segments) == 0:
+                return np.empty((0, 1), dtype=self.pool.dtype)
+            return np.concatenate(segments)
+
+    def segments(self):
+        # read the size first as the chunks are acquired before it is increased
+        size = self.size
+        chunks = list(self.chunks)
+        chunk_size = self.pool.chunk_size
+        start, end = self.window(size)
+        return window_segments(
+            [
+                chunk[: min(chunk_size, size - i * chunk_size)]
+                for i, chunk in enumerate(chunks)
+                if i * chunk_size < size
+            ],
+            start,
+            end,
+        )
+
+    def read(self, start, n):
+        # only look at the chunks that hold the elements
+        chunk_size = self.pool.chunk_size
+        first = self.window()[0] + start
+        first_chunk = first // chunk_size
+        chunks = self.chunks[first_chunk : (first + n - 1) // chunk_size + 1]
+        offset = first - first_chunk * chunk_size
+        return np.concatenate(window_segments(chunks, offset, offset + n))
+
+    def take(self, n):
+        start, end = self.window()
+        if end <= start:
+            return None
+
+        chunk_size = self.pool.chunk_size
+        idx = self.idx if start <= self.idx < end else start
+        chunk_idx, offset = divmod(idx, chunk_size)
+        if offset + n <= chunk_size and idx + n <= end:
+            # fast case: just get the slice
+            self.idx = idx + n if idx + n < end else start
+            return self.chunks[chunk_idx][offset : offset + n]
+
+        # slow case: collect elements from multiple chunks
+        if self.out is None or self.out.shape[0] < n:
+            self.out = np.empty((n, self.chunks[0].shape[1]), dtype=self.pool.dtype)
+
+        collected = 0
+        while collected < n:
+            chunk_idx, offset = divmod(idx, chunk_size)
+            m = min(n - collected, chunk_size - offset, end - idx)
+            self.out[collected : collected + m] = self.chunks[chunk_idx][
+                offset : offset + m
+            ]
+            collected += m
+            idx = idx + m if idx + m < end else start
+
+        self.idx = idx
+        return self.out[:n]
+
+    def clear(self):
+        chunks = self.chunks
+        self.chunks = []
+        self.size = 0
+        self.idx = 0
+        self.reset_window()
+        self.layer = None
+        self.drop_history()
+        for chunk in chunks:
+            self.pool.release(chunk)
+
+    @property
+    def nbytes(self):
+        history = [
+            chunk
+            for layer in list(self.undo_layers) + list(self.redo_layers)
+            for chunk in list(layer.values())
+        ]
+        return sum(chunk.nbytes for chunk in list(self.chunks) + history)
+
+
+class RingFileArray(RingWindowVector):
+    """
+    Array in a file on disk, for recordings that should not be held in memory.
+
+    Appends and reads go through the page cache with positional IO, reads are
+    collected in a reusable buffer, so the result of take is only valid until
+    the next call.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        dtype=np.float32,
+        path: Optional[str] = None,
+        size: int = 0,
+        channels: int = 1,
+    ):
+        """
+        Initialize the data structure.
+
+        :param directory: the directory to create the file in
+        :param dtype: data type of the elements
+        :param path: an existing file to use, a new file is created on first append
+                     if None
+        :param size: number of elements in the existing file
+        :param channels: number of channels in the existing file
+        """
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.fd: Optional[int] = None if path is None else os.open(path, os.O_RDWR)
+        self.path: Optional[str] = path
+        self.size = size
+        self.idx = 0
+        self.out: Optional[np.ndarray] = None
+
+    def _frame_bytes(self):
+        return self.channels * self.dtype.itemsize
+
+    def append(self, x: np.ndarray):
+        if self.fd is None:
+            self.fd, self.path = tempfile.mkstemp(suffix=".raw", dir=self.directory)
+        if self.size == 0:
+            self.channels = x.shape[1]
+        data = np.ascontiguousarray(x, dtype=self.dtype)
+        os.pwrite(self.fd, data, self.size * self._frame_bytes())
+        self.size += x.shape[0]
+
+    def numpy(self):
+        return np.array(self.segments()[0])
+
+    def segments(self):
+        size = self.size
+        if size == 0:
+            return [np.empty((0, self.channels), dtype=self.dtype)]
+        start, end = self.window(size)
+        data = np.memmap(
+            self.path, dtype=self.dtype, mode="r", shape=(size, self.channels)
+        )
+        return [data[start:end]]
+
+    def read(self, start, n):
+        out = np.empty((n, self.channels), dtype=self.dtype)
+        first = self.window()[0] + start
+        os.preadv(self.fd, [out], first * self._frame_bytes())
+        return out
+
+    def take(self, n):
+        start, end = self.window()
+        if end <= start:
+            return None
+
+        if self.out is None or self.out.shape[0] < n:
+            self.out = np.empty((n, self.channels), dtype=self.dtype)
+
+        frame_bytes = self._frame_bytes()
+        idx = self.idx if start <= self.idx < end else start
+        collected = 0
+        while collected < n:
+            m = min(n - collected, end - idx)
+            os.preadv(self.fd, [self.out[collected : collected + m]], idx * frame_bytes)
+            collected += m
+            idx = idx + m if idx + m < end else start
+
+        self.idx = idx
+        return self.out[:n]
+
+    def clear(self):
+        # remove the file, existing snapshots keep their mapping
+        self.size = 0
+        self.idx = 0
+        self.reset_window()
+        if self.fd is not None:
+            os.close(self.fd)
+            os.remove(self.path)
+            self.fd = None
+            self.path = None
+
+    def close(self):
+        # keep the file
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def prefetch(self):
+        if self.fd is not None and hasattr(os, "posix_fadvise"):
+            start, end = self.window()
+            frame_bytes = self._frame_bytes()
+            os.posix_fadvise(
+                self.fd,
+                start * frame_bytes,
+                (end - start) * frame_bytes,
+                os.POSIX_FADV_WILLNEED,
+            )
+
+    @property
+    def nbytes(self):
+        return 0 if self.out is None else self.out.nbytes
+
+    @property
+    def disk_nbytes(self) -> int:
+        return self.size * self._frame_bytes()
+
+
+class RingCompressedArray(RingWindowVector):
+    """
+    Compressed copy of another vector in memory, for recordings that are not
+    played. All elements are kept without loss: integer elements are encoded
+    with FLAC, float elements are compressed with zlib after their bytes have
+    been grouped by significance.
+
+    The vector is read-only. Reads decode the chunk they start in, so recordings
+    should be decompressed before they are played.
+    """
+
+    # FLAC requires a samplerate, it does not affect the encoded elements
+    SAMPLERATE = 48000
+
+    def __init__(self, src: RingAccessVector, chunk_size: int = 2**16):
+        """
+        Compress the elements of a vector.
+
+        :param src: the vector
+        :param chunk_size: number of frames that are encoded together
+        """
+        # encoded chunks and the index of their first element
+        self.blocks: List[bytes] = []
+        self.starts: List[int] = []
+        self.size = 0
+        self.idx = 0
+        self.cached: Optional[np.ndarray] = None
+        self.cached_idx = -1
+        self.out: Optional[np.ndarray] = None
+        self.scale = src.scale
+
+        with src.reading():
+            segments = src.segments()
+            first = segments[0] if len(segments) > 0 else None
+            self.dtype = np.dtype(np.float32 if first is None else first.dtype)
+            self.integer = self.dtype == np.int16
+            self.channels = 1 if first is None else first.shape[1]
+            for segment in segments:
+                for start in range(0, segment.shape[0], chunk_size):
+                    block = segment[start : start + chunk_size]
+                    self.starts.append(self.size)
+                    self.blocks.append(self._encode(block))
+                    self.size += block.shape[0]
+
+    def _encode(self, block: np.ndarray) -> bytes:
+        if self.integer:
+            f = io.BytesIO()
+            sf.write(f, block, self.SAMPLERATE, format="FLAC", subtype="PCM_16")
+            return f.getvalue()
+        # exponents and high mantissa bytes compress well when they are adjacent
+        data = np.ascontiguousarray(block, dtype=self.dtype).view(np.uint8)
+        return zlib.compress(data.reshape(-1, self.dtype.itemsize).T.tobytes(), 1)
+
+    def _decode(self, i: int) -> np.ndarray:
+        if self.integer:
+            data, _ = sf.read(
+                io.BytesIO(self.blocks[i]), dtype=self.dtype.name, always_2d=True
+            )
+            return data
+        data = np.frombuffer(zlib.decompress(self.blocks[i]), dtype=np.uint8)
+        data = np.ascontiguousarray(data.reshape(self.dtype.itemsize, -1).T)
+        return data.view(self.dtype).reshape(-1, self.channels)
+
+    def _block(self, i: int) -> np.ndarray:
+        if i != self.cached_idx:
+            self.cached = self._decode(i)
+            self.cached_idx = i
+        return self.cached
+
+    def append(self, x: np.ndarray):
+        raise ValueError("Compressed recordings cannot be extended")
+
+    def numpy(self):
+        return np.concatenate(self.segments())
+
+    def _decode_range(self, start: int, end: int) -> List[np.ndarray]:
+        # decode the chunks that hold the stored elements [start, end)
+        first = bisect_right(self.starts, start) - 1
+        last = bisect_right(self.starts, end - 1)
+        decoded = [self._decode(i) for i in range(first, last)]
+        offset = self.starts[first]
+        return window_segments(decoded, start - offset, end - offset)
+
+    def segments(self):
+        if self.size == 0:
+            return [np.empty((0, self.channels), dtype=self.dtype)]
+        return self._decode_range(*self.window())
+
+    def read(self, start, n):
+        first = self.window()[0] + start
+        return np.concatenate(self._decode_range(first, first + n))
+
+    def take(self, n):
+        start, end = self.window()
+        if end <= start:
+            return None
+
+        if self.out is None or self.out.shape[0] < n:
+            self.out = np.empty((n, self.channels), dtype=self.dtype)
+
+        idx = self.idx if start <= self.idx < end else start
+        collected = 0
+        while collected < n:
+            i = bisect_right(self.starts, idx) - 1
+            block = self._block(i)
+            offset = idx - self.starts[i]
+            m = min(n - collected, block.shape[0] - offset, end - idx)
+            self.out[collected : collected + m] = block[offset : offset + m]
+            collected += m
+            idx = idx + m if idx + m < end else start
+
+        self.idx = idx
+        return self.out[:n]
+
+    def clear(self):
+        self.blocks = []
+        self.starts = []
+        self.size = 0
+        self.idx = 0
+        self.cached = None
+        self.cached_idx = -1
+        self.reset_window()
+
+    @property
+    def nbytes(self):
+        buffers = [b for b in (self.cached, self.out) if b is not None]
+        return sum(len(b) for b in list(self.blocks)) + sum(b.nbytes for b in buffers)
+
+
+def quantize(
+    x: np.ndarray, dst: np.ndarray, scale: float, scratch: Optional[np.ndarray]
+) -> np.ndarray:
+    """
+    Convert samples to integer elements with rounding and clipping.
+
+    :param x: float samples
+    :param dst: integer array of the same shape that the elements are written to
+    :param scale: value of one element
+    :param scratch: buffer for the conversion from a previous call or None
+    :return: the buffer, it is only reallocated if it is too small
+    """
+    rows, channels = x.shape
+    if scratch is None or scratch.shape[0] < rows or scratch.shape[1] < channels:
+        scratch = np.empty(x.shape, dtype=np.float32)
+    tmp = scratch[:rows, :channels]
+    info = np.iinfo(dst.dtype)
+    np.multiply(x, 1.0 / scale, out=tmp)
+    np.rint(tmp, out=tmp)
+    np.clip(tmp, info.min, info.max, out=tmp)
+    np.copyto(dst, tmp, casting="unsafe")
+    return scratch
+
+
+def to_float32(x: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    """
+    Convert stored elements to float32 samples.
+
+    :param x: elements of a vector
+    :param scale: scale of the vector
+    :return: x itself if it already holds float32 samples, otherwise a converted copy
+    """
+    if x.dtype == np.float32 and scale == 1.0:
+        return x
+    return np.multiply(x, np.float32(scale), dtype=np.float32)
+
+
+def copy_elements(src: RingAccessVector, dst: RingAccessVector, start: int = 0) -> int:
+    """
+    Append the elements of one vector to another, converted to the samples they
+    represent.
+
+    :param src: the source vector
+    :param dst: the destination vector
+    :param start: index of the first element in src that is copied
+    :return: index after the last copied element
+    """
+    offset = 0
+    with src.reading():
+        for segment in src.segments():
+            end = offset + segment.shape[0]
+            if end > start:
+                dst.append(to_float32(segment[max(start - offset, 0) :], src.scale))
+            offset = end
+    return offset
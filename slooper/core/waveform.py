@@ -0,0 +1,218 @@
+"""
+Multi-resolution waveform overview of recordings.
+
+Level 0 holds the minimum, maximum and mean square of bins of BIN_FRAMES
+frames, each following level combines FACTOR bins of the previous one. The
+pyramid is updated while recording, so waveforms can be served without
+reading the audio data.
+"""
+
+from typing import Iterable, List, Tuple
+
+import numpy as np
+from slooper.core.vector import to_float32
+
+BIN_FRAMES = 256
+FACTOR = 4
+LEVELS = 8
+
+
+class PeakPyramid:
+    """
+    Min/max/mean square peaks of a signal at multiple resolutions.
+    """
+
+    def __init__(
+        self, bin_frames: int = BIN_FRAMES, factor: int = FACTOR, levels=LEVELS
+    ):
+        """
+        Initialize an empty pyramid.
+
+        :param bin_frames: number of frames per bin of the finest level
+        :param factor: number of bins that are combined in the next level
+        :param levels: number of levels
+        """
+        self.bin_frames = bin_frames
+        self.factor = factor
+        # columns: min, max, mean square
+        self.levels: List[np.ndarray] = [
+            np.empty((64, 3), dtype=np.float32) for _ in range(levels)
+        ]
+        self.counts = [0] * levels
+        self.frames = 0
+        # incomplete bin of the finest level
+        self.pending_min = np.inf
+        self.pending_max = -np.inf
+        self.pending_sum_sq = 0.0
+        self.pending_frames = 0
+
+    def clear(self):
+        self.counts = [0] * len(self.levels)
+        self.frames = 0
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self.pending_min = np.inf
+        self.pending_max = -np.inf
+        self.pending_sum_sq = 0.0
+        self.pending_frames = 0
+
+    def append(self, data: np.ndarray):
+        """
+        Add frames to the pyramid. The cost is proportional to the number of
+        frames, higher levels are updated with amortized constant cost.
+
+        :param data: array of shape (frames, channels)
+        """
+        n = data.shape[0]
+        if n == 0:
+            return
+        self.frames += n
+        start = 0
+
+        # complete the pending bin
+        if self.pending_frames > 0:
+            start = min(n, self.bin_frames - self.pending_frames)
+            self._add_pending(data[:start])
+            if self.pending_frames < self.bin_frames:
+                return
+            self._push(
+                self.pending_min,
+                self.pending_max,
+                self.pending_sum_sq / (self.bin_frames * data.shape[1]),
+            )
+            self._reset_pending()
+
+        # complete bins of this block
+        bins = (n - start) // self.bin_frames
+        if bins > 0:
+            end = start + bins * self.bin_frames
+            block = data[start:end].reshape(bins, -1)
+            mins = block.min(axis=1)
+            maxs = block.max(axis=1)
+            mean_sq = np.einsum("ij,ij->i", block, block) / block.shape[1]
+            for i in range(bins):
+                self._push(mins[i], maxs[i], mean_sq[i])
+            start = end
+
+        if start < n:
+            self._add_pending(data[start:])
+
+    def _add_pending(self, data: np.ndarray):
+        self.pending_min = min(self.pending_min, data.min())
+        self.pending_max = max(self.pending_max, data.max())
+        self.pending_sum_sq += float(np.vdot(data, data))
+        self.pending_frames += data.shape[0]
+
+    def _push(self, min_value, max_value, mean_sq, level: int = 0):
+        while True:
+            values = self.levels[level]
+            count = self.counts[level]
+            if count == values.shape[0]:
+                # grow geometrically, this rarely happens
+                values = np.concatenate([values, np.empty_like(values)])
+                self.levels[level] = values
+            values[count] = (min_value, max_value, mean_sq)
+            self.counts[level] = count + 1
+
+            # combine the last bins if they form a bin of the next level
+            level += 1
+            count += 1
+            if level == len(self.levels) or count % self.factor != 0:
+                return
+            last = values[count - self.factor : count]
+            min_value = last[:, 0].min()
+            max_value = last[:, 1].max()
+            mean_sq = last[:, 2].mean()
+
+    def get(self, width: int) -> Tuple[np.ndarray, float]:
+        """
+        Get at most width bins of the whole signal from the coarsest level that
+        has enough bins.
+
+        :param width: maximum number of bins
+        :return: array of shape (bins, 3) with min, max and rms of each bin and
+                 the number of frames per bin
+        """
+        # the finest level, pyramids of other processes may not have all levels
+        level = next((i for i, count in enumerate(self.counts) if count > 0), 0)
+        for i in range(len(self.levels)):
+            if self.counts[i] >= width:
+                level = i
+        # the array may be replaced concurrently, its old content remains valid
+        values = self.levels[level]
+        count = min(self.counts[level], values.shape[0])
+        values = values[:count]
+        level_frames = self.bin_frames * self.factor**level
+
+        if count > width:
+            # combine neighbouring bins of the level to get exactly width bins
+            idx = (np.arange(width) * count) // width
+            values = np.stack(
+                [
+                    np.minimum.reduceat(values[:, 0], idx),
+                    np.maximum.reduceat(values[:, 1], idx),
+                    np.add.reduceat(values[:, 2], idx) / np.diff(idx, append=count),
+                ],
+                axis=1,
+            )
+            level_frames *= count / width
+        else:
+            values = values.copy()
+
+        values[:, 2] = np.sqrt(values[:, 2])
+        return values, float(level_frames)
+
+    def get_levels(self, max_bins: int) -> dict:
+        """
+        Copy the levels with at most max_bins bins, e.g. to publish them to
+        another process.
+
+        :param max_bins: maximum number of bins of the finest copied level
+        :return: dict with the number of frames, the index of the finest copied
+                 level and the bins of the copied levels
+        """
+        counts = list(self.counts)
+        first = next(
+            (i for i, count in enumerate(counts) if count <= max_bins),
+            len(counts) - 1,
+        )
+        return {
+            "frames": self.frames,
+            "first": first,
+            "levels": [
+                self.levels[i][: counts[i]].copy() for i in range(first, len(counts))
+            ],
+        }
+
+    def set_levels(self, levels: dict):
+        """
+        Replace the content by levels of get_levels, finer levels are empty.
+
+        :param levels: the copied levels
+        """
+        self.clear()
+        self.frames = levels["frames"]
+        for i, values in enumerate(levels["levels"], levels["first"]):
+            self.levels[i] = values
+            self.counts[i] = values.shape[0]
+
+
+def build_pyramid(
+    segments: Iterable[np.ndarray], scale: float = 1.0, **kwargs
+) -> PeakPyramid:
+    """
+    Compute the pyramid of existing data, e.g. of restored recordings.
+
+    :param segments: arrays of shape (frames, channels)
+    :param scale: value of one element of the segments
+    :param kwargs: arguments of PeakPyramid
+    :return: the pyramid
+    """
+    pyramid = PeakPyramid(**kwargs)
+    for segment in segments:
+        # bounded memory for large segments on disk
+        for start in range(0, segment.shape[0], 1 << 16):
+            segment_slice = segment[start : start + (1 << 16)]
+            pyramid.append(np.asarray(to_float32(segment_slice, scale)))
+    return pyramid